@@ -4,19 +4,53 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import logging
+import time
+
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 
-from models import User, Game
+from models import User, Game, GameChangedError, DEFAULT_PAGE_SIZE,\
+    MAX_PAGE_SIZE
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    GamesForm, UserRankingsForm, GameHistoryForm
-from utils import get_by_urlsafe
+    GamesForm, UserRankingsForm, UserRankingInfoForm, GameHistoryForm,\
+    BoardForm, MoveSuggestionForm, MakeMovesForm, MoveResultForm,\
+    MoveResultsForm
+from utils import get_by_urlsafe, get_by_urlsafe_async, get_cursor,\
+    instrumented, timed
 import kalah
+import kalah_ai
+import kalah_book
+
+# Loaded once, when the instance starts up
+OPENING_BOOK = kalah_book.load_default()
+# Seconds to spend searching for a move suggestion
+SUGGESTION_TIME_LIMIT = 5.0
+# Seconds that wait_for_move waits for a move at most, and between checks
+WAIT_TIMEOUT = 20.0
+WAIT_POLL_INTERVAL = 0.5
+# The most moves make_moves accepts at once
+MAX_BATCH_MOVES = 100
+# Given with the game state when a game changes between a move being
+# checked and being made
+GAME_CHANGED_MESSAGE = 'Game changed before the move was made. Try again.'
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
-        urlsafe_game_key=messages.StringField(1),)
+        urlsafe_game_key=messages.StringField(1),
+        version=messages.IntegerField(2))
+GAME_BOARD_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        ply=messages.IntegerField(2, required=True))
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+        limit=messages.IntegerField(1, default=DEFAULT_PAGE_SIZE),
+        offset=messages.IntegerField(2, default=0),
+        cursor=messages.StringField(3))
+WAIT_FOR_MOVE_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        move_count=messages.IntegerField(2, required=True))
 GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),
         verbose=messages.BooleanField(2, default=False))
@@ -27,6 +61,17 @@ USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2),
     active_only=messages.BooleanField(3, default=True))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    email=messages.StringField(2),
+    active_only=messages.BooleanField(3, default=True),
+    page_size=messages.IntegerField(4, default=DEFAULT_PAGE_SIZE),
+    cursor=messages.StringField(5),
+    summary_only=messages.BooleanField(6, default=False))
+GAMES_PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, default=DEFAULT_PAGE_SIZE),
+    cursor=messages.StringField(2),
+    summary_only=messages.BooleanField(3, default=False))
 
 
 @endpoints.api(name='kalah', version='v1')
@@ -37,13 +82,14 @@ class KalahApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        try:
+            User.create(request.user_name, request.email)
+        except ValueError:
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -52,11 +98,18 @@ class KalahApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
         north_user = self.get_user_or_error(request.north_user_name)
         south_user = self.get_user_or_error(request.south_user_name)
-        game = Game.new_game(north_user.key, south_user.key)
+        try:
+            game = Game.new_game(north_user, south_user,
+                                 request.houses, request.seeds)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Unsupported variant: Kalah({}, {})'.format(request.houses,
+                                                           request.seeds))
 
         return game.to_form('Good luck playing Kalah!')
 
@@ -65,25 +118,50 @@ class KalahApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.active:
-                return game.to_form('Time to make a move!')
-            else:
-                return game.to_form('')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        """Return the current game state. If the game has not changed since
+        the given version, the board is left out of the reply."""
+        form = self.get_game_form(request.urlsafe_game_key)
+        if request.version is not None and request.version == form.version:
+            self.mark_not_modified(form)
+        return form
+
+    @endpoints.method(request_message=WAIT_FOR_MOVE_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_move',
+                      http_method='GET')
+    @instrumented
+    def wait_for_move(self, request):
+        """Wait until more than move_count moves have been made in the game,
+        or it ends or is canceled, then return the game state. Gives up after
+        WAIT_TIMEOUT seconds, returning the game state without the board."""
+        deadline = time.time() + WAIT_TIMEOUT
+        form = self.get_game_form(request.urlsafe_game_key)
+        while form.move_count <= request.move_count and \
+                not (form.game_over or form.canceled):
+            if time.time() + WAIT_POLL_INTERVAL > deadline:
+                self.mark_not_modified(form)
+                break
+            time.sleep(WAIT_POLL_INTERVAL)
+            # Only the version is polled; the form is fetched once it changes
+            if Game.get_cached_version(form.urlsafe_key) != form.version:
+                form = self.get_game_form(form.urlsafe_key)
+        return form
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        # Fetch the game and the moving user at the same time
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        user_future = User.get_by_name_async(request.user_name)
+        game = game_future.get_result()
 
         # Check if game is finished or canceled.
         if game.game_over:
@@ -92,57 +170,190 @@ class KalahApi(remote.Service):
             return game.to_form('Cannot move because Game has been canceled.')
 
         # Check player exists
+        moving_user = user_future.get_result()
+        if not moving_user:
+            raise endpoints.NotFoundException(
+                    'A User with the name {} does not exist!'.format(
+                        request.user_name))
+
+        error = self.check_move(game, moving_user)
+        if error:
+            return game.to_form(error)
+
+        # Try making the move, return error message if invalid
+        try:
+            game = game.move(request.house)
+        except ValueError:
+            return game.to_form('Invalid move.')
+        except GameChangedError as e:
+            return e.game.to_form(GAME_CHANGED_MESSAGE)
+
+        reminder_future = None
+        if not game.game_over:
+            # send a reminder to the next player, while the reply is built
+            reminder_future = game.schedule_reminder_async()
+        form = game.to_form(self.move_message(game))
+        if reminder_future:
+            reminder_future.get_result()
+        return form
+
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=MoveResultsForm,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes moves in several games for one user. Returns a game state
+        with message, or an error, for each move"""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves can be made at once'.format(
+                    MAX_BATCH_MOVES))
         moving_user = self.get_user_or_error(request.user_name)
-        moving_user_id = moving_user.key.id()
+        results = [MoveResultForm(urlsafe_game_key=move.urlsafe_game_key)
+                   for move in request.moves]
+
+        # Load every game at once
+        keys = {}
+        for i, move in enumerate(request.moves):
+            try:
+                key = ndb.Key(urlsafe=move.urlsafe_game_key)
+            except Exception:
+                results[i].error = 'Invalid Key'
+                continue
+            if key.kind() != Game._get_kind():
+                results[i].error = 'Incorrect Kind'
+            elif key in keys.values():
+                results[i].error = 'Game already moved in this request.'
+            else:
+                keys[i] = key
+        games = dict(zip(keys, ndb.get_multi(keys.values())))
+
+        # Start each game's move transaction, then wait for them all
+        futures = {}
+        for i, game in games.items():
+            if not game:
+                results[i].error = 'Game not found!'
+                continue
+            error = self.check_move(game, moving_user)
+            if error:
+                results[i].game = game.to_form(error)
+            else:
+                futures[i] = game.move_async(request.moves[i].house)
+        moved = {}
+        for i, future in futures.items():
+            try:
+                moved[i] = future.get_result()
+            except ValueError:
+                results[i].game = games[i].to_form('Invalid move.')
+            except GameChangedError as e:
+                results[i].game = e.game.to_form(GAME_CHANGED_MESSAGE)
+            except datastore_errors.Error as e:
+                # Such as TransactionFailedError or Timeout. Trying again is
+                # safe even if the move was saved, since the game's version
+                # will then have changed.
+                logging.warning('Move in %s failed: %r', keys[i], e)
+                results[i].error = 'Move failed ({}), please try ' \
+                    'again.'.format(e.__class__.__name__)
+
+        # send reminders to the next players, while the replies are built
+        reminder_future = Game.schedule_reminders_async(
+            [game for game in moved.values() if not game.game_over])
+        Game.fill_user_names(moved.values())
+        for i, game in moved.items():
+            results[i].game = game.to_form(self.move_message(game))
+        reminder_future.get_result()
+        return MoveResultsForm(results=results)
+
+    def check_move(self, game, moving_user):
+        """Return a message explaining why a user cannot move in a game, or
+        None if they can"""
+        # Check if game is finished or canceled.
+        if game.game_over:
+            return 'Game already over.'
+        if game.canceled:
+            return 'Cannot move because Game has been canceled.'
 
         # Check player a participant in game
-        if moving_user_id != game.north_user.id():
-            if moving_user_id != game.south_user.id():
-                return game.to_form('Player not a participant in this game.')
+        moving_user_id = moving_user.key.id()
+        if moving_user_id not in (game.north_user.id(),
+                                  game.south_user.id()):
+            return 'Player not a participant in this game.'
 
         # Check the move is made by the player who's turn it is
         if game.game_state[0] == 'N':
             legitimate_moving_user_id = game.north_user.id()
         else:
             legitimate_moving_user_id = game.south_user.id()
-
         if moving_user_id != legitimate_moving_user_id:
-            return game.to_form('Player moved out of turn.')
-
-        # Try making the move, return error message if invalid
-        try:
-            game = game.move(request.house)
-        except ValueError:
-            return game.to_form('Invalid move.')
+            return 'Player moved out of turn.'
+        return None
 
+    def move_message(self, game):
+        """Return the message sent with a game state after a move"""
         # Check if the game is over, and create appropriate message
-        msg = ''
         if game.game_over:
             msg = 'Game over! '
+            Game.fill_user_names([game])
             if game.north_final_score > game.south_final_score:
-                winner_name = game.north_user.get().name
-                msg += '{} wins!'.format(winner_name)
+                msg += '{} wins!'.format(game.north_user_name)
             elif game.south_final_score > game.north_final_score:
-                winner_name = game.south_user.get().name
-                msg += '{} wins!'.format(winner_name)
+                msg += '{} wins!'.format(game.south_user_name)
             else:
                 msg += "Draw!"
         else:    # If the game isn't over
-            # send a reminder to the next player
-            taskqueue.add(url='/tasks/send_reminder',
-                          params={'urlsafe_key': game.key.urlsafe()})
-
             # Create an appropriate message
-            msg_params = (("North", 7, 12) if game.game_state[0] == 'N'
-                          else ("South", 0, 5))
+            houses = game.variant.player_houses[game.game_state[0]]
+            msg_params = ("North" if game.game_state[0] == 'N' else "South",
+                          houses[0], houses[-1])
             msg = "{} player's turn. Enter an integer between {} and {}."
             msg = msg.format(*msg_params)
+        return msg
 
-        return game.to_form(msg)
+    def get_game_form(self, urlsafe_game_key):
+        """Return the GameForm for the current state of a game, from
+        memcache if possible, or raise API error"""
+        form = Game.get_cached_form(urlsafe_game_key)
+        if form is None:
+            game = get_by_urlsafe(urlsafe_game_key, Game)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            form = game.to_form(game.status_message())
+            game.cache_form()
+        logging.debug('GameForm cache hit rate: %s',
+                      Game.form_cache_hit_rate())
+        return form
+
+    def mark_not_modified(self, form):
+        """Mark a GameForm as unchanged, leaving out the board"""
+        form.not_modified = True
+        form.board = []
+        form.pretty_board = []
+
+    def check_page_size(self, page_size):
+        """Raise API error if page size is out of range"""
+        if not 1 <= page_size <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'page_size must be between 1 and {}'.format(MAX_PAGE_SIZE))
+
+    def games_page_form(self, games, next_cursor, more, summary_only,
+                        game_over=None):
+        """Return a GamesForm for a page of games"""
+        form = GamesForm(more=more)
+        if more and next_cursor:
+            form.next_cursor = next_cursor.urlsafe()
+        if summary_only:
+            form.summaries = [game.to_summary_form(game_over)
+                              for game in games]
+        else:
+            Game.fill_user_names(games)
+            form.games = [game.to_form() for game in games]
+        return form
 
     def get_user_or_error(self, user_name):
         """Get user with given user name or raise API error"""
-        user = User.query(User.name == user_name).get()
+        user = User.get_by_name(user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with the name {} does not exist!'.format(
@@ -151,49 +362,78 @@ class KalahApi(remote.Service):
 
 # = = = Task 3: Extend Your API = = = = = = = = =
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GamesForm,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Get a user's active games."""
+        """Get a page of a user's active games."""
+        self.check_page_size(request.page_size)
         user = self.get_user_or_error(request.user_name)
-        games = user.get_games(active_only=request.active_only)
-        return GamesForm(games=[game.to_form() for game in games])
+        games, next_cursor, more = user.get_games(
+            active_only=request.active_only,
+            page_size=request.page_size,
+            cursor=get_cursor(request.cursor),
+            summary_only=request.summary_only)
+        return self.games_page_form(games, next_cursor, more,
+                                    request.summary_only)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
         """Cancels the specified game, returning an error
         if the game is already over or canceled."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
             try:
-                game.cancel()
+                game = game.cancel()
                 return StringMessage(message='Game successfully canceled.')
             except AttributeError as e:
                 raise endpoints.ForbiddenException(e.message)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(response_message=UserRankingsForm,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=UserRankingsForm,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
         """Retrieve user rankings, according to win:loss ratio,
         with ties broken by greatest number of draws."""
-        return User.rankings()
+        self.check_page_size(request.limit)
+        if request.offset < 0:
+            raise endpoints.BadRequestException('offset must not be negative')
+        try:
+            return User.rankings(request.limit, request.offset,
+                                 request.cursor)
+        except ValueError as e:
+            raise endpoints.BadRequestException(e.message)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankingInfoForm,
+                      path='user/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Retrieve a user's rank in the user rankings."""
+        user = self.get_user_or_error(request.user_name)
+        return user.to_ranking_form(user.get_rank())
 
     @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Retrieve move history for a particular Game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -202,15 +442,63 @@ class KalahApi(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GAME_BOARD_REQUEST,
+                      response_message=BoardForm,
+                      path='history/{urlsafe_game_key}/board',
+                      name='get_game_board',
+                      http_method='GET')
+    @instrumented
+    def get_game_board(self, request):
+        """Retrieve the board of a particular Game after a given number of
+        moves."""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        try:
+            return game.to_board_form(request.ply)
+        except ValueError as e:
+            raise endpoints.BadRequestException(e.message)
+
 # = = = Extra endpoints in response to comments = = = = = = = = =
 
-    @endpoints.method(response_message=GamesForm,
+    @endpoints.method(request_message=GAMES_PAGE_REQUEST,
+                      response_message=GamesForm,
                       path='games/completed',
                       name='get_completed_games',
                       http_method='GET')
+    @instrumented
     def get_completed_games(self, request):
-        """Retrieve all completed games."""
-        games = Game.query(Game.game_over == True).fetch()
-        return GamesForm(games=[game.to_form() for game in games])
+        """Retrieve a page of completed games."""
+        self.check_page_size(request.page_size)
+        games, next_cursor, more = Game.get_completed(
+            page_size=request.page_size,
+            cursor=get_cursor(request.cursor),
+            summary_only=request.summary_only)
+        return self.games_page_form(games, next_cursor, more,
+                                    request.summary_only, game_over=True)
+
+# = = = Computer opponents = = = = = = = = = = = = = = = = = = = =
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=MoveSuggestionForm,
+                      path='game/{urlsafe_game_key}/suggestion',
+                      name='get_move_suggestion',
+                      http_method='GET')
+    @instrumented
+    def get_move_suggestion(self, request):
+        """Suggest a move for the player whose turn it is, from the opening
+        book if possible, otherwise by searching."""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if not game.active:
+            raise endpoints.ForbiddenException('Game is not active.')
+        with timed('ai'):
+            house = kalah_ai.suggest_move(game.game_state,
+                                          time_limit=SUGGESTION_TIME_LIMIT,
+                                          book=OPENING_BOOK)
+        return MoveSuggestionForm(urlsafe_key=game.key.urlsafe(),
+                                  next_to_play=game.game_state[0],
+                                  house=house)
 
 api = endpoints.api_server([KalahApi])
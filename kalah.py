@@ -1,50 +1,194 @@
-"""Module containing all of the functions necessary for a Kalah(6, 3) game.
+"""Module containing all of the functions necessary for a game of Kalah(m, n),
+that is Kalah with m houses per player and n seeds per house. Kalah(6, 3) is
+played by default, and the other variants in VARIANTS are also supported.
 
 This module works in a purely functional manner.
 
 Game state is represented as a tuple of the form (player who moves next,
 board). The player who moves next is represented as either 'N' for the
 northern player or 'S' for the southern player. The Kalah board is represented
-as a tuple of 14 integers (see the documentation for the _newBoard function
-for more information on the representation of the Kalah board).
+as a tuple of integers, 14 for Kalah(6, n) (see the documentation for the
+_newBoard function for more information on the representation of the Kalah
+board).
 
 Functions which alter the game state return a new tuple representing the new
-game state.
+game state. They take an optional Variant, as returned by get_variant, giving
+the constants and tables for the game being played. If no variant is given, it
+is worked out from the board.
 
 For more information on the rules of the game, see:
 https://en.wikipedia.org/wiki/Kalah#Rules
 
 """
 import random
+import struct
+from operator import add
+
+# Supported (houses, seeds) variants
+DEFAULT_VARIANT = (6, 3)
+VARIANTS = (DEFAULT_VARIANT, (4, 4), (6, 4), (6, 6))
+MAX_PITS = max(2 * houses + 2 for houses, seeds in VARIANTS)
+MAX_TOTAL_SEEDS = max(2 * houses * seeds for houses, seeds in VARIANTS)
+# Increased whenever the rules change in a way that means a game played under
+# the old rules may not replay under the new ones. Version 1 finds the last
+# pit sown from the sowing tables, allowing for laps and the skipped store.
+RULES_VERSION = 1
+
+
+class Variant(object):
+    """Constants and precomputed tables for a Kalah(houses, seeds) game.
+
+    Variants are built once, when this module is imported, and are then
+    shared by every game of that variant. Use get_variant to retrieve them.
+
+    Attributes:
+        houses: The number of houses per player.
+        seeds: The number of seeds initially in each house.
+        pits: The total number of houses and stores on the board.
+        total_seeds: The total number of seeds on the board.
+        southern_houses, northern_houses: The indexes of each player's houses.
+        southern_store, northern_store: The indexes of each player's store.
+        stores: A dict mapping 'N', 'S' and 'All' to the relevant stores.
+        player_houses: A dict mapping 'N', 'S' and 'All' to the relevant
+            houses.
+        opposite_houses: A dict mapping each house to the house opposite.
+        sowing_table: See _sowingTable.
+        touched_pits: See _touchedPitsTable.
+    """
+
+    def __init__(self, houses, seeds):
+        self.houses = houses
+        self.seeds = seeds
+        self.pits = 2 * houses + 2
+        self.total_seeds = 2 * houses * seeds
+        self.southern_houses = range(houses)
+        self.northern_houses = range(houses + 1, 2 * houses + 1)
+        self.southern_store = houses
+        self.northern_store = 2 * houses + 1
+        self.stores = {'N': self.northern_store,
+                       'S': self.southern_store,
+                       'All': (self.southern_store, self.northern_store)}
+        self.player_houses = {'N': self.northern_houses,
+                              'S': self.southern_houses,
+                              'All': (self.southern_houses +
+                                      self.northern_houses)}
+        self.opposite_houses = dict(
+            zip(self.southern_houses,
+                reversed(self.northern_houses)) +
+            zip(self.northern_houses,
+                reversed(self.southern_houses)))
+        self.sowing_table = _sowingTable(self)
+        self.touched_pits = _touchedPitsTable(self)
+
+    def __repr__(self):
+        return 'Variant({}, {})'.format(self.houses, self.seeds)
+
+
+def _sowingTable(variant):
+    """Build the table used by _sow to sow any number of seeds in one step.
+
+    Sowing s seeds from house h always changes the board in the same way: h
+    is emptied, then each pit except the opponent's store receives one seed
+    per full lap of the board, plus one more seed for each of the next few
+    pits after h. This only needs to be worked out once per (house, seeds)
+    pair.
+
+    Returns:
+        A dict mapping (house, seeds) to a tuple of the form (delta, last pit
+        sown), where delta is a tuple of integers to add to the board.
+    """
+    table = {}
+    for house in variant.player_houses['All']:
+        # A player does not place seeds in their opponent's store
+        opponents_store = (variant.northern_store
+                           if house < variant.southern_store
+                           else variant.southern_store)
+        delta = [0] * variant.pits
+        current_house = house
+        table[(house, 0)] = (tuple(delta), house)
+        for seeds in range(1, variant.total_seeds + 1):
+            current_house = (current_house + 1) % variant.pits
+            if current_house == opponents_store:
+                current_house = (current_house + 1) % variant.pits
+            delta[current_house] += 1
+            delta[house] -= 1
+            table[(house, seeds)] = (tuple(delta), current_house)
+    return table
+
+
+def _touchedPitsTable(variant):
+    """Build a table of the pits which a move can change.
+
+    Returns:
+        A dict mapping (house, seeds) to a tuple of the pits which may change
+        when that many seeds are sown from that house: the pits sown, plus the
+        pits involved in a capture if one is possible.
+    """
+    table = {}
+    for (house, seeds), (delta, last_house_sown) in \
+            variant.sowing_table.items():
+        player = 'S' if house < variant.southern_store else 'N'
+        pits = set(i for i, d in enumerate(delta) if d)
+        if last_house_sown in variant.player_houses[player]:
+            pits.update((last_house_sown,
+                         variant.opposite_houses[last_house_sown],
+                         variant.stores[player]))
+        table[(house, seeds)] = tuple(sorted(pits))
+    return table
+
+_VARIANTS = dict((key, Variant(*key)) for key in VARIANTS)
+# Variants by (number of pits, number of seeds) on the board
+_BOARD_VARIANTS = dict(((variant.pits, variant.total_seeds), variant)
+                       for variant in _VARIANTS.values())
+
+
+def get_variant(houses=DEFAULT_VARIANT[0], seeds=DEFAULT_VARIANT[1]):
+    """Return the Variant for Kalah(houses, seeds).
+
+    Raises:
+        ValueError: If the variant is not supported.
+    """
+    try:
+        return _VARIANTS[(houses, seeds)]
+    except KeyError:
+        raise ValueError("Unsupported Kalah variant.")
 
-# Useful "constants"
-SOUTHERN_HOUSES = range(6)
-NORTHERN_HOUSES = range(7, 13)
-SOUTHERN_STORE = 6
-NORTHERN_STORE = 13
-STORES = {'N': NORTHERN_STORE,
-          'S': SOUTHERN_STORE,
-          'All': (SOUTHERN_STORE, NORTHERN_STORE)}
-HOUSES = {'N': NORTHERN_HOUSES,
-          'S': SOUTHERN_HOUSES,
-          'All': SOUTHERN_HOUSES + NORTHERN_HOUSES}
-OPPOSITE_HOUSES = dict(
-    zip(SOUTHERN_HOUSES,
-        reversed(NORTHERN_HOUSES)) +
-    zip(NORTHERN_HOUSES,
-        reversed(SOUTHERN_HOUSES)))
-
-
-def newGame(north_starts=True):
-    """Create a new game, with North starting first unless otherwise
-    specified."""
+
+def board_variant(board):
+    """Return the Variant of the game being played on a board.
+
+    Raises:
+        ValueError: If the board does not belong to a supported variant.
+    """
+    try:
+        return _BOARD_VARIANTS[(len(board), sum(board))]
+    except KeyError:
+        raise ValueError("Unsupported Kalah variant.")
+
+# Useful "constants", for Kalah(6, 3)
+_DEFAULT = get_variant()
+SOUTHERN_HOUSES = _DEFAULT.southern_houses
+NORTHERN_HOUSES = _DEFAULT.northern_houses
+SOUTHERN_STORE = _DEFAULT.southern_store
+NORTHERN_STORE = _DEFAULT.northern_store
+TOTAL_SEEDS = _DEFAULT.total_seeds
+STORES = _DEFAULT.stores
+HOUSES = _DEFAULT.player_houses
+OPPOSITE_HOUSES = _DEFAULT.opposite_houses
+SOWING_TABLE = _DEFAULT.sowing_table
+
+
+def newGame(north_starts=True, houses=DEFAULT_VARIANT[0],
+            seeds=DEFAULT_VARIANT[1]):
+    """Create a new game of Kalah(houses, seeds), with North starting first
+    unless otherwise specified."""
     first_player = 'N' if north_starts else 'S'
-    board = _newBoard()
+    board = _newBoard(get_variant(houses, seeds))
     game_state = (first_player, board)
     return game_state
 
 
-def _newBoard():
+def _newBoard(variant=_DEFAULT):
     """Return a kalah(6, 3) board, represented as an array of 14 integers,
     where the the integers at index 6 represents the southern player's
     end-zone,   the integer at index 13 represents the northern player's
@@ -72,82 +216,59 @@ def _newBoard():
     ------------------------
             South --->
 
+    Boards for other variants are laid out in the same way, with
+    variant.houses houses per player.
     """
 
-    return ((3,) * 6 + (0,)) * 2
+    return ((variant.seeds,) * variant.houses + (0,)) * 2
 
 
-def _validateBoard(board):
+def _validateBoard(board, variant=_DEFAULT):
     """Validate a Kalah board.
 
     Args:
-        board: A Kalah board, represented as a tuple of 14 integers.
+        board: A Kalah board, represented as a tuple of integers.
+        variant: The Variant being played.
 
     Returns:
         True if the board is valid, False otherwise.
     """
-    if len(board) != 14 or sum(board) != 36:
+    if len(board) != variant.pits or sum(board) != variant.total_seeds:
         return False
     return True
 
 
-def _validateMove(game_state, house):
+def _validateMove(game_state, house, variant=None):
     """Validates a move.
 
     Checks if the house chosen belongs to the current player, and if it
     contains any tokens."""
 
     player, board = game_state
-    if house not in HOUSES[player]:
+    variant = variant or board_variant(board)
+    if house not in variant.player_houses[player]:
         return False
     if board[house] == 0:
         return False
     return True
 
 
-def _sow(board, house):
+def _sow(board, house, variant):
     """Sows seeds from chosen house, without considering whose move it is or
-    whether the move is valid."""
-
-    seeds = board[house]
-
-    # calculate which house belongs to opponent, so that we can satisfy the
-    # rule that a user does not place seeds in their opponent's store
-    opponents_store = 13 if house < 6 else 6
-
-    # duplicate input board
-    next_board = list(board)[:]
-
-    # remove seeds from chosen house
-    next_board[house] = 0
-
-    # Sow seeds
-    current_house = house
-    while (seeds > 0):
-        current_house = (current_house + 1) % 14
-        # Uses modulo to ensure that indices wrap around to 0 after the last
-        # index is reached. For example, if the user sows from house 12, which
-        # contains 5 seeds, the houses / stores at index 13, 0, 1, 2 and 3
-        # would be incremented.
-
-        if current_house == opponents_store:
-            continue
-        next_board[current_house] += 1
-        seeds -= 1
+    whether the move is valid.
 
-    next_board = tuple(next_board)
+    Returns:
+        A tuple of the form (board after sowing, last pit sown)."""
 
-    return next_board
+    delta, last_house_sown = variant.sowing_table[(house, board[house])]
+    next_board = tuple(map(add, board, delta))
+    return (next_board, last_house_sown)
 
 
-def _capture_opposites(board_pre_sowing,
-                       board_post_sowing,
-                       last_house_sown,
-                       player):
-    """Takes the board state at the beginning of the turn, before any move
-    has been made, and the board state after seeds has been sown, and decides
-    whether capture can take place. If not, returns the board unchanged,
-    otherwise returns the board after capture has taken place.
+def _capture_opposites(board, last_house_sown, player, variant):
+    """Takes the board state after seeds have been sown, and decides whether
+    capture can take place. If not, returns the board unchanged, otherwise
+    returns the board after capture has taken place.
 
     The capture rule is as follows:
         If the last sown seed lands in an empty house owned by the player, and
@@ -155,70 +276,67 @@ def _capture_opposites(board_pre_sowing,
         seeds are captured and placed into the player's store.
 
     Args:
-        board_pre_sowing: The board state at the beginning of the turn.
-        board_post_sowing: The board state after sowing, but before capture
-            has taken place.
+        board: The board state after sowing, but before capture has taken
+            place.
         last_house_sown: The last house sown.
         player: The player whose turn it is.
+        variant: The Variant being played.
 
     Returns:
         If capture takes place, returns the board after capture.
-        Otherwise, returns the board_post_sowing."""
+        Otherwise, returns the board unchanged."""
 
-    if (last_house_sown not in HOUSES[player] or
-            board_pre_sowing[last_house_sown] != 0 or
-            board_pre_sowing[OPPOSITE_HOUSES[last_house_sown]] == 0):
-        return board_post_sowing
+    # The last house was empty if it now holds only the last seed sown
+    if (last_house_sown not in variant.player_houses[player] or
+            board[last_house_sown] != 1 or
+            board[variant.opposite_houses[last_house_sown]] == 0):
+        return board
 
-    winning_store = STORES[player]
-    new_score = (board_post_sowing[winning_store] +
-                 board_post_sowing[OPPOSITE_HOUSES[last_house_sown]] + 1)
-    next_board = tuple(0 if i in (last_house_sown,
-                                  OPPOSITE_HOUSES[last_house_sown])
-                       else new_score if i == winning_store
-                       else n
-                       for i, n in enumerate(board_post_sowing))
-    return next_board
+    winning_store = variant.stores[player]
+    opposite_house = variant.opposite_houses[last_house_sown]
+    next_board = list(board)
+    next_board[winning_store] += board[opposite_house] + 1
+    next_board[last_house_sown] = next_board[opposite_house] = 0
+    return tuple(next_board)
 
 
-def move(game_state, house):
+def move(game_state, house, variant=None):
     """Specifies a move on a board, by giving the house from which 'seeds'
     will be sown.
 
     Args:
         game_state: A tuple of the form (next player, board) representing the
             game state before the move.
-        house: A number between 0 and 5 inclusive for the southern player's
-            houses, or 7 and 12 inclusive for the northern player's houses,
-            representing the house from which the player wishes to sow seeds.
-            representing the house.
+        house: For Kalah(6, n), a number between 0 and 5 inclusive for the
+            southern player's houses, or 7 and 12 inclusive for the northern
+            player's houses, representing the house from which the player
+            wishes to sow seeds.
+        variant: Optionally, the Variant being played.
 
     Returns:
         A tuple of the form (next player, board), representing the game state
         after the move.
     """
 
+    player, old_board = game_state
+    variant = variant or board_variant(old_board)
+
     # Check valid move
-    if not _validateMove(game_state, house):
+    if not _validateMove(game_state, house, variant):
         raise ValueError("Invalid Kalah move.")
 
-    player, old_board = game_state
-
     # Sow seeds
-    next_board = _sow(old_board, house)
+    next_board, last_house_sown = _sow(old_board, house, variant)
 
     # If the last sown seed lands in an empty house owned by the player, and
     # the opposite house contains seeds, both the last seed and the opposite
     # seeds are captured and placed into the player's store.
-    last_house_sown = house + old_board[house]
-    next_board = _capture_opposites(old_board,
-                                    next_board,
-                                    last_house_sown,
-                                    player)
+    next_board = _capture_opposites(next_board, last_house_sown, player,
+                                    variant)
 
     # If the last sown seed lands in the player's store, the player gets an
     # additional move.
-    if last_house_sown == STORES[player]:
+    if last_house_sown == variant.stores[player]:
         next_player = player
     else:
         next_player = 'N' if player == 'S' else 'S'
@@ -226,13 +344,14 @@ def move(game_state, house):
     return (next_player, next_board)
 
 
-def winner(game_state):
+def winner(game_state, variant=None):
     """Indicates the winner of the game if either player has won at this stage
     in the game, or if the game is a draw, and returns None if the game is
     still ongoing.
 
     Args:
         board: A tuple representing the current game state.
+        variant: Optionally, the Variant being played.
 
     Returns:
         If the game is finished, returns the scores in the form
@@ -240,27 +359,250 @@ def winner(game_state):
         Returns None if the game is still ongoing.
     """
     board = game_state[1]
-    north_houses_sum = sum([board[i] for i in NORTHERN_HOUSES])
-    south_houses_sum = sum([board[i] for i in SOUTHERN_HOUSES])
+    variant = variant or board_variant(board)
+    north_houses_sum = sum([board[i] for i in variant.northern_houses])
+    south_houses_sum = sum([board[i] for i in variant.southern_houses])
     if north_houses_sum == 0 or south_houses_sum == 0:
-        north_score = board[NORTHERN_STORE] + north_houses_sum
-        south_score = board[SOUTHERN_STORE] + south_houses_sum
+        north_score = board[variant.northern_store] + north_houses_sum
+        south_score = board[variant.southern_store] + south_houses_sum
         return (south_score, north_score)
 
 
-def print_board(board):
-    """Prettily print a Kalah board."""
+# - - - Zobrist hashing - - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+# Each game state is given a 64-bit hash, formed by XORing together one random
+# key per (pit, number of seeds in pit), plus a key for North moving next. The
+# keys come from a fixed seed, so hashes are stable between processes and can
+# be stored, for example in caches or opening books. The same keys are used
+# for every variant.
 
-    template = """       <--- North
- ------------------------
-  {12:>2}  {11:>2}  {10:>2}  {9:>2}  {8:>2}  {7:>2}
+ZOBRIST_SEED = 0x4b616c6168
+_zobrist_random = random.Random(ZOBRIST_SEED)
+ZOBRIST_PITS = tuple(
+    tuple(_zobrist_random.getrandbits(64)
+          for seeds in range(MAX_TOTAL_SEEDS + 1))
+    for pit in range(MAX_PITS))
+ZOBRIST_NORTH = _zobrist_random.getrandbits(64)
+del _zobrist_random
 
- {13:>3}                 {6:>3}
 
-  {0:>2}  {1:>2}  {2:>2}  {3:>2}  {4:>2}  {5:>2}
- ------------------------
-         South --->
-"""
+def zobrist_hash(game_state):
+    """Return the Zobrist hash of a game state, computed from scratch."""
+    player, board = game_state
+    zobrist = ZOBRIST_NORTH if player == 'N' else 0
+    for pit, seeds in enumerate(board):
+        zobrist ^= ZOBRIST_PITS[pit][seeds]
+    return zobrist
+
+
+def hashed_move(game_state, house, zobrist, variant=None):
+    """Make a move as for move, updating the Zobrist hash of the game state
+    along the way. Only the pits changed by the move are rehashed.
+
+    Args:
+        game_state: A tuple of the form (next player, board) representing the
+            game state before the move.
+        house: The house from which the player wishes to sow seeds.
+        zobrist: The Zobrist hash of game_state.
+        variant: Optionally, the Variant being played.
+
+    Returns:
+        A tuple of the form (game state after the move, its Zobrist hash).
+    """
+    old_board = game_state[1]
+    variant = variant or board_variant(old_board)
+    next_game_state = move(game_state, house, variant)
+    next_board = next_game_state[1]
+    for pit in variant.touched_pits[(house, old_board[house])]:
+        old_seeds = old_board[pit]
+        next_seeds = next_board[pit]
+        if old_seeds != next_seeds:
+            zobrist ^= (ZOBRIST_PITS[pit][old_seeds] ^
+                        ZOBRIST_PITS[pit][next_seeds])
+    if next_game_state[0] != game_state[0]:
+        zobrist ^= ZOBRIST_NORTH
+    return (next_game_state, zobrist)
+
+
+# - - - Compact encoding - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+# A byte string encoding of the game state, for storage: one byte for the
+# player who moves next ('N' or 'S'), followed by one byte per pit.
+
+_STATE_STRUCTS = dict((variant.pits,
+                       struct.Struct('c{}B'.format(variant.pits)))
+                      for variant in _VARIANTS.values())
+_BOARD_STRUCTS = dict((variant.pits, struct.Struct('{}B'.format(variant.pits)))
+                      for variant in _VARIANTS.values())
+
+
+def encode_state(game_state):
+    """Encode a game state of the form (next player, board) as a byte
+    string."""
+    player, board = game_state
+    return _STATE_STRUCTS[len(board)].pack(player, *board)
+
+
+def decode_state(data):
+    """Decode a byte string written by encode_state back into a tuple of the
+    form (next player, board)."""
+    return (data[0], _BOARD_STRUCTS[len(data) - 1].unpack_from(data, 1))
+
+
+# - - - Packed game state - - - - - - - - - - - - - - - - - - - - - - - - - -
+#
+# An alternative representation of the game state, intended for self-play and
+# analysis jobs which apply very large numbers of moves. The whole game state
+# is packed into a single integer: pit i of the board occupies the PIT_BITS
+# bits starting at bit (i * PIT_BITS), and the bit at PLAYER_SHIFT is set when
+# North moves next. Only Kalah(6, 3) games can be packed.
+
+PIT_BITS = 6
+PIT_MASK = (1 << PIT_BITS) - 1
+PLAYER_SHIFT = 14 * PIT_BITS
+
+
+def _pits_mask(pits):
+    """Return a mask covering the packed fields of the given pits."""
+    return sum(PIT_MASK << (i * PIT_BITS) for i in pits)
+
+PACKED_HOUSES_MASKS = {'N': _pits_mask(NORTHERN_HOUSES),
+                       'S': _pits_mask(SOUTHERN_HOUSES)}
+
+
+def _packedSowingTable():
+    """Convert SOWING_TABLE for use by packed_move.
+
+    Returns:
+        A dict mapping each house to a list indexed by the number of seeds in
+        that house. Each entry is a tuple of the form (increment, last pit
+        sown), where increment is the packed form of the board delta.
+    """
+    table = {}
+    for house in HOUSES['All']:
+        table[house] = []
+        for seeds in range(TOTAL_SEEDS + 1):
+            delta, last_house_sown = SOWING_TABLE[(house, seeds)]
+            increment = sum(d << (i * PIT_BITS) for i, d in enumerate(delta))
+            table[house].append((increment, last_house_sown))
+    return table
+
+_PACKED_SOWS = _packedSowingTable()
+
+
+def pack(game_state):
+    """Convert a game state of the form (next player, board) into its packed
+    integer representation."""
+    player, board = game_state
+    packed = 1 << PLAYER_SHIFT if player == 'N' else 0
+    for i, seeds in enumerate(board):
+        packed |= seeds << (i * PIT_BITS)
+    return packed
+
+
+def unpack(packed):
+    """Convert a packed game state back into a tuple of the form
+    (next player, board)."""
+    player = 'N' if packed >> PLAYER_SHIFT else 'S'
+    board = tuple((packed >> (i * PIT_BITS)) & PIT_MASK for i in range(14))
+    return (player, board)
+
+
+def _validatePackedMove(packed, house):
+    """Validates a move on a packed game state.
+
+    Checks if the house chosen belongs to the current player, and if it
+    contains any tokens."""
+
+    player = 'N' if packed >> PLAYER_SHIFT else 'S'
+    if house not in HOUSES[player]:
+        return False
+    if not (packed >> (house * PIT_BITS)) & PIT_MASK:
+        return False
+    return True
+
+
+def packed_move(packed, house):
+    """Equivalent of move for packed game states.
+
+    Args:
+        packed: An integer representing the packed game state before the
+            move.
+        house: The house from which the player wishes to sow seeds, as for
+            move.
+
+    Returns:
+        An integer representing the packed game state after the move.
+    """
+
+    if not _validatePackedMove(packed, house):
+        raise ValueError("Invalid Kalah move.")
+
+    player = 'N' if packed >> PLAYER_SHIFT else 'S'
+
+    # Empty the chosen house and sow all of its seeds in one addition
+    seeds = (packed >> (house * PIT_BITS)) & PIT_MASK
+    increment, last_house_sown = _PACKED_SOWS[house][seeds]
+    packed += increment
+
+    # Capture, if the last seed landed in an empty house owned by the player
+    # and the opposite house contains seeds.
+    if last_house_sown in HOUSES[player]:
+        last_shift = last_house_sown * PIT_BITS
+        opposite_shift = OPPOSITE_HOUSES[last_house_sown] * PIT_BITS
+        captured = (packed >> opposite_shift) & PIT_MASK
+        if (packed >> last_shift) & PIT_MASK == 1 and captured:
+            packed -= (1 << last_shift) + (captured << opposite_shift)
+            packed += (captured + 1) << (STORES[player] * PIT_BITS)
+
+    # The player only moves again if the last seed landed in their store
+    if last_house_sown != STORES[player]:
+        packed ^= 1 << PLAYER_SHIFT
+
+    return packed
+
+
+def packed_winner(packed):
+    """Equivalent of winner for packed game states.
+
+    Returns:
+        If the game is finished, returns the scores in the form
+        (south, north).
+        Returns None if the game is still ongoing.
+    """
+    if (packed & PACKED_HOUSES_MASKS['N'] and
+            packed & PACKED_HOUSES_MASKS['S']):
+        return None
+    board = unpack(packed)[1]
+    return winner(('S', board), _DEFAULT)
+
+
+def _board_template(houses):
+    """Return the template used by print_board for boards with the given
+    number of houses per player."""
+    width = 4 * houses
+    north_row = '  ' + '  '.join('{%d:>2}' % i
+                                 for i in range(2 * houses, houses, -1))
+    south_row = '  ' + '  '.join('{%d:>2}' % i for i in range(houses))
+    stores_row = ' {%d:>3}%s{%d:>3}' % (2 * houses + 1, ' ' * (width - 7),
+                                        houses)
+    lines = [' ' * (width // 2 - 5) + '<--- North',
+             ' ' + '-' * width,
+             north_row,
+             '',
+             stores_row,
+             '',
+             south_row,
+             ' ' + '-' * width,
+             ' ' * (width // 2 - 3) + 'South --->',
+             '']
+    return '\n'.join(lines)
+
+
+def print_board(board):
+    """Prettily print a Kalah board."""
+
+    template = _board_template(len(board) // 2 - 1)
     return template.format(*board)
 
 
@@ -268,21 +610,26 @@ def print_board_plus_legend(board):
     """Return a string, representing in easily readable format: a board, plus
     a 'legend' showing the numbers of each house / store, side by side"""
 
+    houses = len(board) // 2 - 1
     board_lines = print_board(board).splitlines()
-    legend_vals = range(6) + ["(6)"] + range(7, 13) + ["(13)"]
+    legend_vals = (range(houses) + ["({})".format(houses)] +
+                   range(houses + 1, 2 * houses + 1) +
+                   ["({})".format(2 * houses + 1)])
     legend_lines = print_board(legend_vals).splitlines()
     lines = ("{:<30}{:<30}".format(*pair)
              for pair in zip(board_lines, legend_lines))
     return '\n'.join(lines)
 
 
-def command_line_game():
+def command_line_game(houses=DEFAULT_VARIANT[0], seeds=DEFAULT_VARIANT[1]):
 
-    game_state = newGame(north_starts=random.choice([True, False]))
+    variant = get_variant(houses, seeds)
+    game_state = newGame(north_starts=random.choice([True, False]),
+                         houses=houses, seeds=seeds)
 
     while True:
         player, board = game_state
-        final_scores = winner(game_state)
+        final_scores = winner(game_state, variant)
         if final_scores:
             print print_board(board)
             print "South: {}, North: {}".format(*final_scores)
@@ -297,7 +644,7 @@ def command_line_game():
             try:
                 next_move = int(
                     raw_input("Your move {}: ".format(player_name)))
-                new_game_state = move(game_state, next_move)
+                new_game_state = move(game_state, next_move, variant)
                 valid_move = True
             except ValueError as e:
                 print "Invalid move. Please try again."
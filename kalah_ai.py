@@ -0,0 +1,237 @@
+"""kalah_ai.py - Computer opponents for Kalah.
+
+Moves are chosen by a negamax search with alpha-beta pruning, using the rules
+in kalah.py. The search deepens iteratively until its time budget runs out, so
+that a move is always available within an App Engine request deadline.
+
+Scores are always given from the point of view of the player who moves next,
+as the number of seeds that player is ahead by.
+"""
+import time
+
+import kalah
+
+# Transposition table entry flags
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+DEFAULT_TIME_LIMIT = 1.0    # seconds
+DEFAULT_MAX_DEPTH = 64
+DEFAULT_TABLE_SIZE = 200000
+# The clock is only checked once every this many nodes
+CLOCK_CHECK_INTERVAL = 1024
+
+
+class _OutOfTime(Exception):
+    """Raised inside the search when the time budget has been used up."""
+
+
+def evaluate(game_state, variant=None):
+    """Return a heuristic score for the game state, from the point of view of
+    the player who moves next."""
+    player, board = game_state
+    variant = variant or kalah.board_variant(board)
+    final_scores = kalah.winner(game_state, variant)
+    if final_scores:
+        south_score, north_score = final_scores
+        score = south_score - north_score
+    else:
+        score = board[variant.southern_store] - board[variant.northern_store]
+    return score if player == 'S' else -score
+
+
+def ordered_moves(game_state, first=None, variant=None):
+    """Return the valid moves for the game state, best candidates first.
+
+    Moves which give the player an extra turn are tried first, since they are
+    usually strong. Within each group, moves are tried from the house nearest
+    the player's store.
+
+    Args:
+        game_state: A tuple of the form (next player, board).
+        first: Optionally, a move to try before all others, such as the best
+            move found by an earlier search.
+        variant: Optionally, the Variant being played.
+    """
+    player, board = game_state
+    variant = variant or kalah.board_variant(board)
+    store = variant.stores[player]
+    extra_turns = []
+    others = []
+    for house in reversed(variant.player_houses[player]):
+        seeds = board[house]
+        if not seeds or house == first:
+            continue
+        if variant.sowing_table[(house, seeds)][1] == store:
+            extra_turns.append(house)
+        else:
+            others.append(house)
+    moves = extra_turns + others
+    # Hash collisions mean a remembered move may not be valid here
+    if first in variant.player_houses[player] and board[first]:
+        moves.insert(0, first)
+    return moves
+
+
+class AlphaBetaPlayer(object):
+    """Chooses moves by iterative deepening alpha-beta search.
+
+    The transposition table is keyed by the Zobrist hash of each game state,
+    and is kept between calls to choose_move, so a player that is reused
+    across the moves of a game benefits from earlier searches. The number of
+    entries is bounded by table_size; the table is cleared once it fills up.
+
+    If an endgame database (a kalah_endgame.EndgameDatabase) is given, the
+    positions it covers are scored exactly rather than searched.
+    """
+
+    def __init__(self, time_limit=DEFAULT_TIME_LIMIT,
+                 max_depth=DEFAULT_MAX_DEPTH,
+                 table_size=DEFAULT_TABLE_SIZE,
+                 endgame=None):
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.endgame = endgame
+        self.table = {}
+        # Statistics for the most recent search
+        self.nodes = 0
+        self.elapsed = 0.0
+        self.depth_reached = 0
+        self._deadline = None
+        self._variant = None
+
+    def nodes_per_second(self):
+        """Return the search speed of the most recent call to choose_move."""
+        if not self.elapsed:
+            return 0.0
+        return self.nodes / self.elapsed
+
+    def choose_move(self, game_state):
+        """Return the best move found for the game state within the time
+        limit.
+
+        Raises:
+            ValueError: If the game is already over.
+        """
+        self._variant = kalah.board_variant(game_state[1])
+        if kalah.winner(game_state, self._variant):
+            raise ValueError("Game is already over.")
+
+        start = time.time()
+        self._deadline = start + self.time_limit
+        self.nodes = 0
+        self.depth_reached = 0
+        best_move = ordered_moves(game_state, variant=self._variant)[0]
+        zobrist = kalah.zobrist_hash(game_state)
+        try:
+            for depth in range(1, self.max_depth + 1):
+                best_move = self._search_root(game_state, zobrist, depth,
+                                              best_move)
+                self.depth_reached = depth
+        except _OutOfTime:
+            pass
+        self.elapsed = time.time() - start
+        return best_move
+
+    def _search_root(self, game_state, zobrist, depth, previous_best):
+        """Search every move at the root, returning the best one."""
+        player = game_state[0]
+        alpha = -self._variant.total_seeds - 1
+        beta = self._variant.total_seeds + 1
+        best_move = previous_best
+        for house in ordered_moves(game_state, previous_best, self._variant):
+            child, child_zobrist = kalah.hashed_move(game_state, house,
+                                                     zobrist, self._variant)
+            if child[0] == player:
+                value = self._negamax(child, child_zobrist, depth - 1,
+                                      alpha, beta)
+            else:
+                value = -self._negamax(child, child_zobrist, depth - 1,
+                                       -beta, -alpha)
+            if value > alpha:
+                alpha = value
+                best_move = house
+        return best_move
+
+    def _negamax(self, game_state, zobrist, depth, alpha, beta):
+        """Return the value of the game state searched to the given depth,
+        from the point of view of the player who moves next. zobrist is the
+        Zobrist hash of the game state."""
+        self.nodes += 1
+        if (not self.nodes % CLOCK_CHECK_INTERVAL and
+                time.time() > self._deadline):
+            raise _OutOfTime()
+
+        variant = self._variant
+        if kalah.winner(game_state, variant):
+            return evaluate(game_state, variant)
+        if self.endgame is not None:
+            value = self.endgame.value(game_state)
+            if value is not None:
+                return value
+        if depth <= 0:
+            return evaluate(game_state, variant)
+
+        entry = self.table.get(zobrist)
+        table_move = None
+        if entry is not None:
+            entry_depth, value, flag, table_move = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value
+                elif flag == LOWER_BOUND:
+                    alpha = max(alpha, value)
+                elif flag == UPPER_BOUND:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        original_alpha = alpha
+        player = game_state[0]
+        best_value = -variant.total_seeds - 1
+        best_move = None
+        for house in ordered_moves(game_state, table_move, variant):
+            child, child_zobrist = kalah.hashed_move(game_state, house,
+                                                     zobrist, variant)
+            # A player who earns an extra turn keeps the same point of view
+            if child[0] == player:
+                value = self._negamax(child, child_zobrist, depth - 1,
+                                      alpha, beta)
+            else:
+                value = -self._negamax(child, child_zobrist, depth - 1,
+                                       -beta, -alpha)
+            if value > best_value:
+                best_value = value
+                best_move = house
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_value >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        if len(self.table) >= self.table_size:
+            self.table.clear()
+        self.table[zobrist] = (depth, best_value, flag, best_move)
+        return best_value
+
+
+def suggest_move(game_state, time_limit=DEFAULT_TIME_LIMIT, book=None):
+    """Return the best move found for the game state within time_limit
+    seconds.
+
+    Args:
+        game_state: A tuple of the form (next player, board).
+        time_limit: The most time, in seconds, to spend searching.
+        book: Optionally, a kalah_book.OpeningBook to check before searching.
+    """
+    if book is not None:
+        house = book.move(game_state)
+        if house is not None:
+            return house
+    return AlphaBetaPlayer(time_limit=time_limit).choose_move(game_state)
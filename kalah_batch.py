@@ -0,0 +1,118 @@
+"""kalah_batch.py - Apply moves to many Kalah boards at once.
+
+batch_move steps a whole batch of positions in a handful of NumPy array
+operations, using the sowing table from kalah.py, rather than calling
+kalah.move once per board. If NumPy is not available, the same results are
+computed by calling kalah.move for each board in turn.
+
+Players are represented in batches by the integers SOUTH (0) and NORTH (1).
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import kalah
+
+SOUTH = 0
+NORTH = 1
+PLAYERS = ('S', 'N')
+
+
+def _tables():
+    """Convert the sowing table and board layout from kalah.py into arrays
+    indexed by pit (and number of seeds, for the sowing table)."""
+    deltas = np.zeros((14, kalah.TOTAL_SEEDS + 1, 14), dtype=np.int32)
+    last_pits = np.zeros((14, kalah.TOTAL_SEEDS + 1), dtype=np.int32)
+    for (house, seeds), (delta, last) in kalah.SOWING_TABLE.items():
+        deltas[house, seeds] = delta
+        last_pits[house, seeds] = last
+    # Stores are their own "opposite", but are never captured from
+    opposites = np.arange(14)
+    for house, opposite in kalah.OPPOSITE_HOUSES.items():
+        opposites[house] = opposite
+    stores = np.array([kalah.SOUTHERN_STORE, kalah.NORTHERN_STORE])
+    first_houses = np.array([kalah.SOUTHERN_HOUSES[0],
+                             kalah.NORTHERN_HOUSES[0]])
+    return deltas, last_pits, opposites, stores, first_houses
+
+if np is not None:
+    _DELTAS, _LAST_PITS, _OPPOSITES, _STORES, _FIRST_HOUSES = _tables()
+
+
+def _owned(pits, players):
+    """Return a mask of which pits are houses owned by the given players."""
+    offsets = pits - _FIRST_HOUSES[players]
+    return (offsets >= 0) & (offsets < 6)
+
+
+def batch_move(boards, players, houses):
+    """Apply one move to each of a batch of positions.
+
+    Args:
+        boards: An N x 14 array of integers, one board per row.
+        players: An array of N players, SOUTH or NORTH, moving next.
+        houses: An array of N houses to sow from.
+
+    Returns:
+        A tuple of the form (next boards, next players, valid, terminal).
+        valid is a boolean array marking which moves were valid; positions
+        with an invalid move are returned unchanged. terminal is a boolean
+        array marking which of the next positions end the game.
+    """
+    if np is None:
+        return _batch_move_python(boards, players, houses)
+
+    boards = np.asarray(boards, dtype=np.int32)
+    players = np.asarray(players, dtype=np.int32)
+    houses = np.asarray(houses, dtype=np.int32)
+    rows = np.arange(len(boards))
+
+    # Check the moves, making invalid ones sow nothing
+    pits = np.clip(houses, 0, 13)
+    seeds = boards[rows, pits]
+    valid = ((houses == pits) & _owned(pits, players) & (seeds > 0))
+    seeds = np.where(valid, np.minimum(seeds, kalah.TOTAL_SEEDS), 0)
+
+    # Sow all seeds at once
+    next_boards = boards + _DELTAS[pits, seeds]
+    last_pits = _LAST_PITS[pits, seeds]
+
+    # Capture where the last seed landed in an empty house owned by the
+    # player, and the opposite house contains seeds
+    opposites = _OPPOSITES[last_pits]
+    captured = next_boards[rows, opposites]
+    capture = (valid & _owned(last_pits, players) &
+               (next_boards[rows, last_pits] == 1) & (captured > 0))
+    capture_rows = rows[capture]
+    next_boards[capture_rows, _STORES[players[capture]]] += (
+        captured[capture] + 1)
+    next_boards[capture_rows, last_pits[capture]] = 0
+    next_boards[capture_rows, opposites[capture]] = 0
+
+    # The player only moves again if the last seed landed in their store
+    switch = valid & (last_pits != _STORES[players])
+    next_players = np.where(switch, 1 - players, players)
+
+    terminal = ((next_boards[:, kalah.SOUTHERN_HOUSES].sum(axis=1) == 0) |
+                (next_boards[:, kalah.NORTHERN_HOUSES].sum(axis=1) == 0))
+    return (next_boards, next_players, valid, terminal)
+
+
+def _batch_move_python(boards, players, houses):
+    """Equivalent of batch_move using lists, for when NumPy is missing."""
+    next_boards = []
+    next_players = []
+    valid = []
+    terminal = []
+    for board, player, house in zip(boards, players, houses):
+        game_state = (PLAYERS[player], tuple(board))
+        try:
+            game_state = kalah.move(game_state, house)
+            valid.append(True)
+        except ValueError:
+            valid.append(False)
+        next_boards.append(list(game_state[1]))
+        next_players.append(PLAYERS.index(game_state[0]))
+        terminal.append(kalah.winner(game_state) is not None)
+    return (next_boards, next_players, valid, terminal)
@@ -0,0 +1,471 @@
+"""kalah_bench.py - Benchmarks for the Kalah rules engine.
+
+Run from the command line:
+
+    python -m kalah_bench moves [--positions N] [--repeat R] [--seed S]
+    python -m kalah_bench perft [--depth D] [--engine NAME ...]
+    python -m kalah_bench batch [--positions N] [--seed S]
+    python -m kalah_bench encoding [--positions N] [--seed S]
+    python -m kalah_bench replay [--games N] [--seed S]
+
+The moves benchmark compares the number of moves per second applied by each
+engine over the same set of positions.
+
+The perft benchmark walks the whole game tree from kalah.newGame() to a fixed
+depth, for both starting players, counting the positions reached after each
+number of moves. Every move counts as a ply, including extra turns, and
+finished games are not expanded any further. The counts are checked against
+PERFT_COUNTS, so that a single run checks the engine for both correctness and
+speed. Each engine and starting player runs in a fresh Python process, whose
+peak memory use is reported along with its growth during the walk.
+
+The batch benchmark checks kalah_batch.batch_move against kalah.move on random
+positions, including invalid moves, then compares their speed.
+
+The encoding benchmark compares the size and encode/decode speed of the
+compact game state encoding (kalah.encode_state) with pickling, as used by the
+Game model's game_state property before.
+
+The replay benchmark checks kalah_replay.state_at, with and without
+snapshots, against replaying each random game one move at a time, then
+compares the speed of looking up every ply with and without snapshots.
+"""
+import argparse
+import cPickle as pickle
+import functools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import kalah
+import kalah_batch
+import kalah_replay
+
+# Number of positions reached after 0, 1, 2, ... moves from kalah.newGame(),
+# by starting player.
+PERFT_COUNTS = {
+    'N': (1, 6, 35, 182, 904, 4243, 19418, 87103, 387726, 1715619),
+    'S': (1, 6, 35, 182, 904, 4243, 19418, 87103, 387726, 1715619),
+}
+
+
+class Engine(object):
+    """A rules engine exposing the same interface as kalah.move and
+    kalah.winner, over its own representation of the game state.
+
+    Args:
+        name: The name used to select the engine from the command line.
+        encode: A function converting a game state of the form
+            (next player, board) into the engine's representation.
+        move: Equivalent of kalah.move.
+        winner: Equivalent of kalah.winner.
+        valid_moves: A function returning a list of the valid moves for a
+            game state in the engine's representation.
+    """
+
+    def __init__(self, name, encode, move, winner, valid_moves):
+        self.name = name
+        self.encode = encode
+        self.move = move
+        self.winner = winner
+        self.valid_moves = valid_moves
+
+
+def _tuple_valid_moves(game_state):
+    player, board = game_state
+    return [house for house in kalah.HOUSES[player] if board[house]]
+
+
+def _packed_valid_moves(packed):
+    player = 'N' if packed >> kalah.PLAYER_SHIFT else 'S'
+    return [house for house in kalah.HOUSES[player]
+            if (packed >> (house * kalah.PIT_BITS)) & kalah.PIT_MASK]
+
+
+ENGINES = {
+    'tuple': Engine('tuple', lambda game_state: game_state,
+                    functools.partial(kalah.move, variant=kalah.get_variant()),
+                    functools.partial(kalah.winner,
+                                      variant=kalah.get_variant()),
+                    _tuple_valid_moves),
+    'packed': Engine('packed', kalah.pack,
+                     kalah.packed_move, kalah.packed_winner,
+                     _packed_valid_moves),
+}
+
+
+def random_positions(count, seed=0):
+    """Collect positions reached during random games, each paired with a
+    valid move for that position.
+
+    Args:
+        count: The number of (game state, house) pairs to collect.
+        seed: Seed for the random number generator, so that runs are
+            reproducible.
+
+    Returns:
+        A list of (game state, house) tuples.
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        game_state = kalah.newGame(north_starts=rng.random() < 0.5)
+        while kalah.winner(game_state) is None and len(positions) < count:
+            house = rng.choice(_tuple_valid_moves(game_state))
+            positions.append((game_state, house))
+            game_state = kalah.move(game_state, house)
+    return positions
+
+
+def _time_moves(move, positions, repeat):
+    """Return the best time, in seconds, taken to apply every move in
+    positions, over repeat runs."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for state, house in positions:
+            move(state, house)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_moves(engines, count=100000, repeat=3, seed=0):
+    """Measure moves per second for each engine over the same set of
+    positions.
+
+    Returns:
+        A dict mapping engine name to moves per second.
+    """
+    positions = random_positions(count, seed)
+    results = {}
+    for engine in engines:
+        encoded = [(engine.encode(game_state), house)
+                   for game_state, house in positions]
+        elapsed = _time_moves(engine.move, encoded, repeat)
+        results[engine.name] = len(encoded) / elapsed
+    return results
+
+
+def perft(engine, state, depth):
+    """Count the positions reached from state after each number of moves,
+    up to depth moves.
+
+    Returns:
+        A list of depth + 1 integers, the first of which counts state itself.
+    """
+    counts = [0] * (depth + 1)
+    move = engine.move
+    winner = engine.winner
+    valid_moves = engine.valid_moves
+
+    def walk(state, ply):
+        counts[ply] += 1
+        if ply == depth or winner(state) is not None:
+            return
+        for house in valid_moves(state):
+            walk(move(state, house), ply + 1)
+
+    walk(state, 0)
+    return counts
+
+
+def _perft_child(engine_name, player, depth):
+    """Run perft for one engine and starting player, printing the result as
+    JSON. Run in a fresh interpreter by bench_perft, so that the peak memory
+    use of the process belongs to this run alone."""
+    engine = ENGINES[engine_name]
+    start_state = engine.encode(kalah.newGame(north_starts=player == 'N'))
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    counts = perft(engine, start_state, depth)
+    elapsed = time.time() - start
+    print json.dumps({
+        'counts': counts,
+        'elapsed': elapsed,
+        'baseline_memory_kb': baseline,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def bench_perft(engine, depth):
+    """Run perft for both starting players, each in its own Python process,
+    checking the counts against PERFT_COUNTS where they are known.
+
+    Returns:
+        A list of dicts, one per starting player, giving the counts, whether
+        they are correct (None if unknown), nodes per second, and the peak
+        memory use in kilobytes of the process which ran perft, before and
+        after running it.
+    """
+    results = []
+    for player in ('N', 'S'):
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import kalah_bench; kalah_bench._perft_child({!r}, {!r}, {:d})'
+             .format(engine.name, player, depth)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        child = json.loads(output)
+        known = PERFT_COUNTS[player]
+        results.append({
+            'player': player,
+            'counts': child['counts'],
+            'correct': (tuple(child['counts']) == known[:depth + 1]
+                        if depth < len(known) else None),
+            'nodes_per_second': sum(child['counts'][1:]) / child['elapsed'],
+            'baseline_memory_kb': child['baseline_memory_kb'],
+            'peak_memory_kb': child['peak_memory_kb'],
+        })
+    return results
+
+
+def random_batch(count, seed=0):
+    """Collect a batch of random positions, with a random house for each.
+    About one in eight houses is chosen at random from the whole board, so
+    that the batch includes invalid moves.
+
+    Returns:
+        A tuple of the form (boards, players, houses) of lists, in the form
+        taken by kalah_batch.batch_move.
+    """
+    rng = random.Random(seed)
+    boards = []
+    players = []
+    houses = []
+    for game_state, house in random_positions(count, seed):
+        if rng.random() < 0.125:
+            house = rng.randrange(14)
+        boards.append(list(game_state[1]))
+        players.append(kalah_batch.PLAYERS.index(game_state[0]))
+        houses.append(house)
+    return (boards, players, houses)
+
+
+def _batch_row(results, i):
+    """Return row i of the results of a batch move as plain Python values."""
+    next_boards, next_players, valid, terminal = results
+    return (list(next_boards[i]), int(next_players[i]),
+            bool(valid[i]), bool(terminal[i]))
+
+
+def check_batch(count=100000, seed=0):
+    """Check that kalah_batch.batch_move gives exactly the same results as
+    kalah.move, one board at a time, on a random batch.
+
+    Returns:
+        A list of the indexes of positions where the results differ.
+    """
+    boards, players, houses = random_batch(count, seed)
+    expected = kalah_batch._batch_move_python(boards, players, houses)
+    actual = kalah_batch.batch_move(boards, players, houses)
+    mismatches = []
+    for i in range(count):
+        if _batch_row(expected, i) != _batch_row(actual, i):
+            mismatches.append(i)
+    return mismatches
+
+
+def bench_batch(count=100000, seed=0):
+    """Measure positions per second for kalah_batch.batch_move and for
+    calling kalah.move once per board.
+
+    Returns:
+        A dict mapping method name to positions per second.
+    """
+    batch = random_batch(count, seed)
+    results = {}
+    for name, function in (('per-board', kalah_batch._batch_move_python),
+                           ('batch', kalah_batch.batch_move)):
+        start = time.time()
+        function(*batch)
+        results[name] = count / (time.time() - start)
+    return results
+
+
+def bench_encoding(count=100000, seed=0):
+    """Measure the mean size and the encodes and decodes per second of the
+    compact and pickle encodings of game states.
+
+    Returns:
+        A dict mapping encoding name to a tuple of the form (mean size in
+        bytes, encodes per second, decodes per second).
+    """
+    states = [game_state for game_state, house in random_positions(count,
+                                                                    seed)]
+    encodings = (
+        ('compact', kalah.encode_state, kalah.decode_state),
+        # ndb.PickleProperty pickles with protocol 2
+        ('pickle', functools.partial(pickle.dumps, protocol=2),
+         pickle.loads),
+    )
+    results = {}
+    for name, encode, decode in encodings:
+        start = time.time()
+        encoded = [encode(game_state) for game_state in states]
+        encode_time = time.time() - start
+        start = time.time()
+        decoded = [decode(data) for data in encoded]
+        decode_time = time.time() - start
+        assert decoded == states
+        results[name] = (float(sum(len(data) for data in encoded)) / count,
+                         count / encode_time, count / decode_time)
+    return results
+
+
+def random_histories(count, seed=0):
+    """Play count random games of Kalah(6, 3) to the end.
+
+    Returns:
+        A list of the histories of the games, as lists of houses played.
+    """
+    rng = random.Random(seed)
+    histories = []
+    for _ in range(count):
+        game_state = kalah.newGame(north_starts=rng.random() < 0.5)
+        history = []
+        while kalah.winner(game_state) is None:
+            house = rng.choice(_tuple_valid_moves(game_state))
+            history.append(house)
+            game_state = kalah.move(game_state, house)
+        histories.append(history)
+    return histories
+
+
+def check_replay(histories):
+    """Check kalah_replay.state_at, with and without snapshots, against
+    replaying each game one move at a time.
+
+    Returns:
+        A list of (game index, ply) pairs where the results differ.
+    """
+    variant = kalah.get_variant()
+    mismatches = []
+    for i, history in enumerate(histories):
+        snapshots = kalah_replay.snapshots(history, variant)
+        game_state = kalah_replay.initial_state(history, variant)
+        for ply in range(len(history) + 1):
+            if ply:
+                game_state = kalah.move(game_state, history[ply - 1])
+            if (kalah_replay.state_at(history, ply, variant) != game_state or
+                    kalah_replay.state_at(history, ply, variant,
+                                          snapshots) != game_state):
+                mismatches.append((i, ply))
+    return mismatches
+
+
+def bench_replay(histories):
+    """Measure lookups per second of the state at every ply of each game,
+    with and without snapshots.
+
+    Returns:
+        A dict mapping method name to lookups per second.
+    """
+    variant = kalah.get_variant()
+    all_snapshots = [kalah_replay.snapshots(history, variant)
+                     for history in histories]
+    lookups = sum(len(history) + 1 for history in histories)
+    results = {}
+    for name, use_snapshots in (('replay', False), ('snapshots', True)):
+        start = time.time()
+        for history, snapshots in zip(histories, all_snapshots):
+            if not use_snapshots:
+                snapshots = ()
+            for ply in range(len(history) + 1):
+                kalah_replay.state_at(history, ply, variant, snapshots)
+        results[name] = lookups / (time.time() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark')
+    moves_parser = subparsers.add_parser('moves')
+    moves_parser.add_argument('--positions', type=int, default=100000)
+    moves_parser.add_argument('--repeat', type=int, default=3)
+    moves_parser.add_argument('--seed', type=int, default=0)
+    perft_parser = subparsers.add_parser('perft')
+    perft_parser.add_argument('--depth', type=int, default=7)
+    batch_parser = subparsers.add_parser('batch')
+    batch_parser.add_argument('--positions', type=int, default=100000)
+    batch_parser.add_argument('--seed', type=int, default=0)
+    encoding_parser = subparsers.add_parser('encoding')
+    encoding_parser.add_argument('--positions', type=int, default=100000)
+    encoding_parser.add_argument('--seed', type=int, default=0)
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('--games', type=int, default=1000)
+    replay_parser.add_argument('--seed', type=int, default=0)
+    for subparser in (moves_parser, perft_parser):
+        subparser.add_argument('--engine', action='append',
+                               choices=sorted(ENGINES))
+    args = parser.parse_args()
+
+    if args.benchmark == 'replay':
+        histories = random_histories(args.games, args.seed)
+        mismatches = check_replay(histories)
+        print "equivalence: {}".format(
+            "{:,} mismatches, first at {}".format(len(mismatches),
+                                                  mismatches[0])
+            if mismatches else "ok")
+        print "mean game length {:.1f} plies, snapshots every {}".format(
+            float(sum(map(len, histories))) / len(histories),
+            kalah_replay.SNAPSHOT_INTERVAL)
+        results = bench_replay(histories)
+        for name in ('replay', 'snapshots'):
+            print "{:<10}{:>12,.0f} lookups/sec".format(name, results[name])
+        if mismatches:
+            raise SystemExit(1)
+        return
+
+    if args.benchmark == 'encoding':
+        results = bench_encoding(args.positions, args.seed)
+        for name in ('compact', 'pickle'):
+            print ("{:<8}{:>6.1f} bytes  {:>12,.0f} encodes/sec  "
+                   "{:>12,.0f} decodes/sec").format(name, *results[name])
+        return
+
+    if args.benchmark == 'batch':
+        if kalah_batch.np is None:
+            print "NumPy is not installed: batch_move falls back to kalah.move"
+        mismatches = check_batch(args.positions, args.seed)
+        print "equivalence: {}".format(
+            "{:,} mismatches, first at {}".format(len(mismatches),
+                                                  mismatches[0])
+            if mismatches else "ok")
+        results = bench_batch(args.positions, args.seed)
+        for name in ('per-board', 'batch'):
+            print "{:<10}{:>12,.0f} positions/sec".format(name, results[name])
+        if mismatches:
+            raise SystemExit(1)
+        return
+
+    engines = [ENGINES[name] for name in args.engine or ('tuple', 'packed')]
+    if args.benchmark == 'moves':
+        results = bench_moves(engines, args.positions, args.repeat,
+                              args.seed)
+        for engine in engines:
+            print "{:<8}{:>12,.0f} moves/sec".format(engine.name,
+                                                     results[engine.name])
+    else:
+        failed = False
+        for engine in engines:
+            for result in bench_perft(engine, args.depth):
+                status = {True: 'ok', False: 'MISMATCH',
+                          None: 'unchecked'}[result['correct']]
+                failed = failed or result['correct'] is False
+                print ("{:<8}{}  leaves {:>10,}  {:>10,.0f} nodes/sec  "
+                       "peak {:,} KB (+{:,})  {}").format(
+                           engine.name, result['player'],
+                           result['counts'][-1],
+                           result['nodes_per_second'],
+                           result['peak_memory_kb'],
+                           result['peak_memory_kb'] -
+                           result['baseline_memory_kb'], status)
+        if failed:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
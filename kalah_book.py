@@ -0,0 +1,155 @@
+"""kalah_book.py - Opening book of precomputed moves for the first few plies.
+
+Every game starts from kalah.newGame(), so the first few positions of every
+game are the same few thousand. The book holds the best move for each of
+them, found by a deep search done offline, keyed by Zobrist hash.
+
+Generate the book from the command line:
+
+    python -m kalah_book --plies 4 --depth 14 --out opening_book.bin
+
+The file starts with a header giving the number of entries, followed by the
+hashes of every position as unsigned 64-bit integers, then one byte per
+position giving the house to play. Loading it is a single unpack of each
+array into a dict, so it takes a few milliseconds.
+"""
+import argparse
+import os
+import struct
+import time
+
+import kalah
+import kalah_ai
+
+MAGIC = 'KALAHOB1'
+HEADER = struct.Struct('<8sI')    # magic, number of entries
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'opening_book.bin')
+
+
+class OpeningBook(object):
+    """A set of precomputed moves, keyed by the Zobrist hash of the position.
+
+    Args:
+        moves: A dict mapping Zobrist hash to the house to play.
+    """
+
+    def __init__(self, moves):
+        self.moves = moves
+
+    def __len__(self):
+        return len(self.moves)
+
+    def move(self, game_state):
+        """Return the book move for a game state, or None if it is not in the
+        book."""
+        house = self.moves.get(kalah.zobrist_hash(game_state))
+        # Guard against hash collisions with positions outside the book
+        if house is None or not kalah._validateMove(game_state, house):
+            return None
+        return house
+
+    def save(self, path):
+        """Write the book to path."""
+        hashes = sorted(self.moves)
+        with open(path, 'wb') as book_file:
+            book_file.write(HEADER.pack(MAGIC, len(hashes)))
+            book_file.write(struct.pack('<{}Q'.format(len(hashes)), *hashes))
+            book_file.write(bytearray(self.moves[h] for h in hashes))
+
+    @classmethod
+    def load(cls, path):
+        """Read a book written by save.
+
+        Raises:
+            ValueError: If the file is not an opening book.
+        """
+        with open(path, 'rb') as book_file:
+            data = book_file.read()
+        magic, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a Kalah opening book.")
+        hashes = struct.unpack_from('<{}Q'.format(count), data, HEADER.size)
+        moves = bytearray(data[HEADER.size + 8 * count:])
+        return cls(dict(zip(hashes, moves)))
+
+
+def load_default():
+    """Return the book at DEFAULT_PATH, or None if there is no book."""
+    if not os.path.exists(DEFAULT_PATH):
+        return None
+    return OpeningBook.load(DEFAULT_PATH)
+
+
+def book_positions(plies, houses=kalah.DEFAULT_VARIANT[0],
+                   seeds=kalah.DEFAULT_VARIANT[1]):
+    """Return every position reached in at most plies moves from a new game,
+    with either player starting, that is not already over.
+
+    Returns:
+        A dict mapping Zobrist hash to game state.
+    """
+    variant = kalah.get_variant(houses, seeds)
+    frontier = [kalah.newGame(north_starts, houses, seeds)
+                for north_starts in (True, False)]
+    positions = {}
+    for ply in range(plies + 1):
+        next_frontier = []
+        for game_state in frontier:
+            zobrist = kalah.zobrist_hash(game_state)
+            if zobrist in positions or kalah.winner(game_state, variant):
+                continue
+            positions[zobrist] = game_state
+            player, board = game_state
+            for house in variant.player_houses[player]:
+                if board[house]:
+                    next_frontier.append(kalah.move(game_state, house,
+                                                    variant))
+        frontier = next_frontier
+    return positions
+
+
+def generate(plies, max_depth, time_limit=float('inf'), **variant):
+    """Search every position in the first plies moves of the game.
+
+    Args:
+        plies: The number of moves covered by the book.
+        max_depth: The depth to search each position to.
+        time_limit: The most time, in seconds, to spend on each position.
+        variant: houses and seeds, to generate a book for a Kalah variant.
+
+    Returns:
+        An OpeningBook.
+    """
+    player = kalah_ai.AlphaBetaPlayer(time_limit=time_limit,
+                                      max_depth=max_depth)
+    moves = {}
+    for zobrist, game_state in book_positions(plies, **variant).items():
+        moves[zobrist] = player.choose_move(game_state)
+    return OpeningBook(moves)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plies', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=14)
+    parser.add_argument('--time-limit', type=float, default=float('inf'))
+    parser.add_argument('--houses', type=int, default=kalah.DEFAULT_VARIANT[0])
+    parser.add_argument('--seeds', type=int, default=kalah.DEFAULT_VARIANT[1])
+    parser.add_argument('--out', default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    start = time.time()
+    book = generate(args.plies, args.depth, args.time_limit,
+                    houses=args.houses, seeds=args.seeds)
+    book.save(args.out)
+    print "{:,} positions searched in {:.1f}s".format(len(book),
+                                                      time.time() - start)
+
+    start = time.time()
+    OpeningBook.load(args.out)
+    print "{} is {:,} bytes, loaded in {:.1f}ms".format(
+        args.out, os.path.getsize(args.out), (time.time() - start) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""kalah_endgame.py - Retrograde endgame database for Kalah(6, n).
+
+Once seeds are in a store they stay there, so the outcome of the rest of a
+game only depends on the seeds left in the houses and on who moves next. For
+every position with at most max_seeds seeds in its houses, the database holds
+the exact number of those seeds which the player to move will collect, less
+the number their opponent will collect, assuming perfect play by both. The
+rules only depend on the number of houses, so one database serves every
+Kalah(6, n) variant.
+
+Build a database from the command line, reporting build time and file size:
+
+    python -m kalah_endgame --max-seeds 6 8 10 --out endgame
+
+Positions are solved in order of the number of seeds in their houses. A move
+either puts seeds into a store, reducing that number, or moves seeds towards
+the player's own store without leaving their side of the board, so every
+position's children are solved before the position itself. Every distribution
+of up to max_seeds seeds over the houses is solved, which includes all
+reachable positions.
+
+The file starts with a header, followed by one signed byte per position with
+South to move. Positions with North to move are looked up by rotating the
+board half a turn, which swaps the players. Positions are indexed by a
+perfect hash: the rank of the distribution of seeds over the twelve houses
+among all distributions of up to max_seeds seeds.
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+
+import kalah
+
+MAGIC = 'KALAHEG1'
+HEADER = struct.Struct('<8sHH')    # magic, houses per player, max_seeds
+VARIANT = kalah.get_variant()
+HOUSES = VARIANT.southern_houses + VARIANT.northern_houses
+
+
+def _ways(seeds, bins):
+    """Return the number of ways of placing seeds seeds into bins bins."""
+    # C(seeds + bins - 1, bins - 1)
+    ways = 1
+    for i in range(1, bins):
+        ways = ways * (seeds + i) // i
+    return ways
+
+
+def _offsets(max_seeds):
+    """Build the table used by _rank.
+
+    Returns:
+        A list, indexed by house number i (0 to 11), remaining seeds r and
+        seeds in house i v, of the number of distributions of r seeds over
+        houses i to 11 which have fewer than v seeds in house i. A slack bin
+        after the last house takes up any seeds left over.
+    """
+    offsets = []
+    for i in range(len(HOUSES)):
+        bins_after = len(HOUSES) - i    # later houses, plus the slack bin
+        by_remaining = []
+        for remaining in range(max_seeds + 1):
+            counts = [0]
+            for v in range(remaining):
+                counts.append(counts[-1] + _ways(remaining - v, bins_after))
+            by_remaining.append(counts)
+        offsets.append(by_remaining)
+    return offsets
+
+
+def _rank(houses, max_seeds, offsets):
+    """Return the index of a distribution of at most max_seeds seeds over the
+    twelve houses, given as a sequence of seed counts."""
+    index = 0
+    remaining = max_seeds
+    for i, seeds in enumerate(houses):
+        index += offsets[i][remaining][seeds]
+        remaining -= seeds
+    return index
+
+
+def _houses(game_state):
+    """Return the seeds in the houses of a game state, rotated if need be so
+    that the player to move comes first."""
+    player, board = game_state
+    if player == 'S':
+        return board[0:6] + board[7:13]
+    return board[7:13] + board[0:6]
+
+
+def _distributions(max_seeds, bins=len(HOUSES)):
+    """Yield every distribution of up to max_seeds seeds over bins houses."""
+    if bins == 0:
+        yield ()
+        return
+    for seeds in range(max_seeds + 1):
+        for rest in _distributions(max_seeds - seeds, bins - 1):
+            yield (seeds,) + rest
+
+
+def build(max_seeds):
+    """Solve every position with at most max_seeds seeds in its houses.
+
+    Returns:
+        A bytearray holding, for each position with South to move in rank
+        order, its value as a signed byte.
+    """
+    offsets = _offsets(max_seeds)
+    size = _ways(max_seeds, len(HOUSES) + 1)
+    values = [None] * size
+
+    def progress(houses):
+        # Increases with every move that keeps all seeds in the houses
+        return sum(seeds * (i % 6) for i, seeds in enumerate(houses))
+
+    order = sorted(_distributions(max_seeds),
+                   key=lambda houses: (sum(houses), -progress(houses)))
+    for houses in order:
+        board = houses[0:6] + (0,) + houses[6:12] + (0,)
+        game_state = ('S', board)
+        final_scores = kalah.winner(game_state, VARIANT)
+        if final_scores:
+            value = final_scores[0] - final_scores[1]
+        else:
+            value = None
+            for house in VARIANT.southern_houses:
+                if not board[house]:
+                    continue
+                child = kalah.move(game_state, house, VARIANT)
+                gained = child[1][VARIANT.southern_store]
+                child_value = values[_rank(_houses(child), max_seeds,
+                                           offsets)]
+                if child_value is None:
+                    raise AssertionError("Child solved out of order.")
+                if child[0] == 'S':
+                    child_value = gained + child_value
+                else:
+                    child_value = gained - child_value
+                value = child_value if value is None else max(value,
+                                                              child_value)
+        values[_rank(houses, max_seeds, offsets)] = value
+    return bytearray(struct.pack('{}b'.format(size), *values))
+
+
+def write(path, max_seeds):
+    """Build the database for max_seeds and write it to path."""
+    values = build(max_seeds)
+    with open(path, 'wb') as output:
+        output.write(HEADER.pack(MAGIC, VARIANT.houses, max_seeds))
+        output.write(values)
+
+
+class EndgameDatabase(object):
+    """A memory-mapped endgame database file.
+
+    Args:
+        path: The path of a file written by write.
+
+    Raises:
+        ValueError: If the file is not an endgame database.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as db_file:
+            self._map = mmap.mmap(db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, houses, self.max_seeds = HEADER.unpack_from(self._map)
+        if magic != MAGIC or houses != VARIANT.houses:
+            raise ValueError("Not a Kalah(6, n) endgame database.")
+        self._offsets = _offsets(self.max_seeds)
+
+    def close(self):
+        self._map.close()
+
+    def value(self, game_state):
+        """Return the final score difference for a game state, from the point
+        of view of the player to move, under perfect play.
+
+        Returns:
+            An integer, or None if the database does not cover the position.
+        """
+        player, board = game_state
+        houses = _houses(game_state)
+        seeds = sum(houses)
+        if seeds > self.max_seeds or len(board) != VARIANT.pits:
+            return None
+        index = HEADER.size + _rank(houses, self.max_seeds, self._offsets)
+        value = struct.unpack_from('b', self._map, index)[0]
+        stores = VARIANT.stores
+        opponent = 'N' if player == 'S' else 'S'
+        return board[stores[player]] - board[stores[opponent]] + value
+
+    def lookup(self, game_state):
+        """Return the final scores of a game under perfect play, in the same
+        form as kalah.winner: (south, north).
+
+        Returns:
+            A tuple of two integers, or None if the database does not cover
+            the position.
+        """
+        difference = self.value(game_state)
+        if difference is None:
+            return None
+        if game_state[0] == 'N':
+            difference = -difference
+        total_seeds = sum(game_state[1])
+        south_score = (total_seeds + difference) // 2
+        return (south_score, total_seeds - south_score)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-seeds', type=int, nargs='+', default=[10])
+    parser.add_argument('--out', default='.')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    for max_seeds in args.max_seeds:
+        path = os.path.join(args.out, 'endgame-{}.db'.format(max_seeds))
+        start = time.time()
+        write(path, max_seeds)
+        print "K={:<3} {:>12,} positions  {:>8.1f}s  {:>12,} bytes  {}".format(
+            max_seeds, _ways(max_seeds, len(HOUSES) + 1), time.time() - start,
+            os.path.getsize(path), path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""kalah_export.py - Compact archive format for finished games, for analysis.
+
+An archive holds games in chunks, each laid out in columns, so that a reader
+can map whole columns straight out of the file as arrays instead of parsing
+one record at a time. Games are dicts of the form used by kalah_selfplay,
+plus the variant and the players' names:
+
+    {"houses": 6, "seeds": 3, "first": "N", "moves": [9, 2, ...],
+     "scores": [south, north], "north": "alice", "south": "bob"}
+
+The file starts with MAGIC, followed by the chunks. Each chunk starts with
+CHUNK_HEADER, giving the number of games n, the width w of the move arrays
+(the length of the longest game in the chunk), and the number and total
+length of the distinct player names in the chunk. Then come its columns, in
+this order, all little-endian:
+
+    north_player  uint32[n]      index of each game's North player's name
+    south_player  uint32[n]      index of each game's South player's name
+    name_offsets  uint32[k + 1]  where each name starts in names
+    move_count    uint16[n]      number of moves in each game
+    houses        uint8[n]
+    seeds         uint8[n]
+    first         uint8[n]       1 if North moved first, 0 if South did
+    south_score   uint8[n]
+    north_score   uint8[n]
+    moves         uint8[n * w]   moves of each game, padded with NO_MOVE
+    names         bytes          the names, encoded as UTF-8
+
+and padding to a multiple of four bytes. After the last chunk comes the
+index, giving the offset of each chunk as uint64, then FOOTER, giving the
+offset of the index, the number of chunks and MAGIC again.
+
+Benchmark against JSON from the command line:
+
+    python -m kalah_export --games 100000 --out games.kex
+"""
+import argparse
+import array
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import kalah
+
+MAGIC = 'KALAHEX1'
+# games, width of move arrays, distinct names, bytes of names
+CHUNK_HEADER = struct.Struct('<IIII')
+# offset of index, number of chunks, magic
+FOOTER = struct.Struct('<QI8s')
+NO_MOVE = 0xff
+
+# Name, array typecode, NumPy dtype and item size of each column before the
+# moves, in file order
+_COLUMNS = (
+    ('north_player', 'I', '<u4', 4),
+    ('south_player', 'I', '<u4', 4),
+    ('name_offsets', 'I', '<u4', 4),
+    ('move_count', 'H', '<u2', 2),
+    ('houses', 'B', 'u1', 1),
+    ('seeds', 'B', 'u1', 1),
+    ('first', 'B', 'u1', 1),
+    ('south_score', 'B', 'u1', 1),
+    ('north_score', 'B', 'u1', 1),
+)
+
+
+def _padding(size):
+    """Return the bytes needed to pad size bytes to a multiple of four."""
+    return '\0' * (-size % 4)
+
+
+def encode_chunk(games):
+    """Encode a list of games as one chunk of an archive.
+
+    Returns:
+        A string of bytes.
+    """
+    names = []
+    name_indexes = {}
+    for game in games:
+        for player in ('north', 'south'):
+            if game[player] not in name_indexes:
+                name_indexes[game[player]] = len(names)
+                names.append(game[player].encode('utf-8'))
+    name_offsets = [0]
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    width = max(len(game['moves']) for game in games) if games else 0
+    moves = bytearray([NO_MOVE]) * (len(games) * width)
+    for i, game in enumerate(games):
+        moves[i * width:i * width + len(game['moves'])] = bytearray(
+            game['moves'])
+
+    count = len(games)
+    parts = [
+        CHUNK_HEADER.pack(count, width, len(names), name_offsets[-1]),
+        struct.pack('<{}I'.format(count),
+                    *[name_indexes[game['north']] for game in games]),
+        struct.pack('<{}I'.format(count),
+                    *[name_indexes[game['south']] for game in games]),
+        struct.pack('<{}I'.format(len(name_offsets)), *name_offsets),
+        struct.pack('<{}H'.format(count),
+                    *[len(game['moves']) for game in games]),
+        str(bytearray(game['houses'] for game in games)),
+        str(bytearray(game['seeds'] for game in games)),
+        str(bytearray(int(game['first'] == 'N') for game in games)),
+        str(bytearray(game['scores'][0] for game in games)),
+        str(bytearray(game['scores'][1] for game in games)),
+        str(moves),
+    ]
+    parts.extend(names)
+    data = ''.join(parts)
+    return data + _padding(len(data))
+
+
+class ArchiveWriter(object):
+    """Writes an archive one chunk at a time, so that only one chunk needs
+    to be held in memory.
+
+    Args:
+        output: A file-like object opened for writing in binary mode. It
+            need not be seekable.
+    """
+
+    def __init__(self, output):
+        self._output = output
+        self._output.write(MAGIC)
+        self._position = len(MAGIC)
+        self._offsets = []
+
+    def write_chunk(self, games):
+        """Write a list of games as the next chunk."""
+        self.write_encoded_chunk(encode_chunk(games))
+
+    def write_encoded_chunk(self, data):
+        """Write a chunk already encoded by encode_chunk."""
+        self._output.write(data)
+        self._offsets.append(self._position)
+        self._position += len(data)
+
+    def close(self):
+        """Write the index and footer. The output is not closed."""
+        self._output.write(archive_end(self._offsets, self._position))
+
+
+def archive_end(offsets, index_offset):
+    """Return the index and footer which end an archive, for writing an
+    archive in parts without an ArchiveWriter.
+
+    Args:
+        offsets: The offset of each chunk in the archive.
+        index_offset: The offset of the index, just after the last chunk.
+    """
+    return (struct.pack('<{}Q'.format(len(offsets)), *offsets) +
+            FOOTER.pack(index_offset, len(offsets), MAGIC))
+
+
+class Chunk(object):
+    """One chunk of an archive, giving its columns as arrays. The arrays
+    are NumPy arrays mapped straight from the file if NumPy is available,
+    otherwise copies of the file's bytes as array.arrays.
+
+    Args:
+        data: The archive's bytes, such as an mmap.
+        offset: The offset of the chunk in data.
+    """
+
+    def __init__(self, data, offset):
+        self.games, self.width, names, names_size = \
+            CHUNK_HEADER.unpack_from(data, offset)
+        position = offset + CHUNK_HEADER.size
+        for name, typecode, dtype, size in _COLUMNS:
+            count = names + 1 if name == 'name_offsets' else self.games
+            setattr(self, name, _column(data, position, typecode, dtype,
+                                        count))
+            position += count * size
+        self.moves = _column(data, position, 'B', 'u1',
+                             self.games * self.width)
+        if np is not None:
+            self.moves = self.moves.reshape((self.games, self.width))
+        position += self.games * self.width
+        self._names = data[position:position + names_size]
+        self._name_cache = None
+
+    def names(self):
+        """Return the list of distinct player names in the chunk, indexed by
+        the north_player and south_player columns."""
+        if self._name_cache is None:
+            offsets = self.name_offsets
+            self._name_cache = [
+                self._names[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(len(offsets) - 1)]
+        return self._name_cache
+
+    def game(self, i):
+        """Return game i of the chunk as a dict."""
+        if np is not None:
+            moves = self.moves[i, :self.move_count[i]].tolist()
+        else:
+            start = i * self.width
+            moves = self.moves[start:start + self.move_count[i]].tolist()
+        names = self.names()
+        return {'houses': int(self.houses[i]), 'seeds': int(self.seeds[i]),
+                'first': 'N' if self.first[i] else 'S', 'moves': moves,
+                'scores': [int(self.south_score[i]),
+                           int(self.north_score[i])],
+                'north': names[self.north_player[i]],
+                'south': names[self.south_player[i]]}
+
+
+def _column(data, offset, typecode, dtype, count):
+    """Return count items of a column starting at offset in data."""
+    if np is not None:
+        return np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    column = array.array(typecode)
+    column.fromstring(data[offset:offset + count * column.itemsize])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+class GameArchive(object):
+    """A memory-mapped archive file.
+
+    Args:
+        path: The path of a file written by ArchiveWriter.
+
+    Raises:
+        ValueError: If the file is not an archive.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as archive_file:
+            self._map = mmap.mmap(archive_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        index_offset, chunks, magic = FOOTER.unpack_from(
+            self._map, len(self._map) - FOOTER.size)
+        if self._map[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError("Not a Kalah game archive.")
+        offsets = struct.unpack_from('<{}Q'.format(chunks), self._map,
+                                     index_offset)
+        self.chunks = [Chunk(self._map, offset) for offset in offsets]
+
+    def __len__(self):
+        return sum(chunk.games for chunk in self.chunks)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for i in range(chunk.games):
+                yield chunk.game(i)
+
+    def close(self):
+        self.chunks = []
+        self._map.close()
+
+
+def random_games(count, seed=0, players=1000):
+    """Play count random games of Kalah(6, 3) between randomly chosen
+    players, for benchmarking."""
+    # Imported here, since the app imports this module but cannot use
+    # multiprocessing
+    import kalah_selfplay
+    rng = random.Random(seed)
+    policy = kalah_selfplay.random_policy(rng)
+    names = ['player{}'.format(i) for i in range(players)]
+    games = []
+    for _ in range(count):
+        game = kalah_selfplay.play_game(policy, policy, rng.random() < 0.5)
+        game.update(houses=kalah.DEFAULT_VARIANT[0],
+                    seeds=kalah.DEFAULT_VARIANT[1],
+                    north=rng.choice(names), south=rng.choice(names))
+        games.append(game)
+    return games
+
+
+def _json_record(game):
+    """Return the JSON that get_completed_games and get_game_history give
+    for a game between them, as one line."""
+    game_state = kalah.newGame(north_starts=game['first'] == 'N')
+    for house in game['moves']:
+        game_state = kalah.move(game_state, house)
+    board = game_state[1]
+    return json.dumps({
+        'game_over': True, 'canceled': False, 'message': '',
+        'north_user_name': game['north'], 'south_user_name': game['south'],
+        'next_to_play': game_state[0], 'board': list(board),
+        'pretty_board': kalah.print_board_plus_legend(board).splitlines(),
+        'south_final_score': game['scores'][0],
+        'north_final_score': game['scores'][1],
+        'houses': game['houses'], 'seeds': game['seeds'],
+        'history': game['moves']}, separators=(',', ':')) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='games.kex')
+    args = parser.parse_args()
+
+    games = random_games(args.games, args.seed)
+    json_path = os.path.splitext(args.out)[0] + '.jsonl'
+
+    start = time.time()
+    with open(json_path, 'wb') as output:
+        for game in games:
+            output.write(_json_record(game))
+    json_write = time.time() - start
+    start = time.time()
+    with open(args.out, 'wb') as output:
+        writer = ArchiveWriter(output)
+        for first in range(0, len(games), args.chunk_size):
+            writer.write_chunk(games[first:first + args.chunk_size])
+        writer.close()
+    archive_write = time.time() - start
+
+    # Read every game's South score, and total them
+    start = time.time()
+    with open(json_path, 'rb') as json_file:
+        json_total = sum(json.loads(line)['south_final_score']
+                         for line in json_file)
+    json_read = time.time() - start
+    start = time.time()
+    archive = GameArchive(args.out)
+    archive_total = sum(int(chunk.south_score.sum()) if np is not None
+                        else sum(chunk.south_score)
+                        for chunk in archive.chunks)
+    archive_read = time.time() - start
+
+    if list(archive) != games or archive_total != json_total:
+        raise SystemExit("Archive does not match the games written.")
+    archive.close()
+    print "NumPy: {}".format("yes" if np is not None else "no")
+    for name, path, write_time, read_time in (
+            ('json', json_path, json_write, json_read),
+            ('archive', args.out, archive_write, archive_read)):
+        size = os.path.getsize(path)
+        print ("{:<8}{:>12,} bytes  {:>6.1f} bytes/game  "
+               "{:>10,.0f} games/sec written  {:>12,.0f} scores/sec "
+               "read").format(name, size, float(size) / len(games),
+                              len(games) / write_time,
+                              len(games) / read_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""kalah_replay.py - Rebuilds the state of a game at any ply from its history.
+
+A game's history is the list of houses played. Replaying it with kalah.move
+from the start gives the state after any number of moves, but costs one move
+per ply. Snapshots of the state every SNAPSHOT_INTERVAL plies are kept
+alongside the history, so the state at ply k is found by replaying from the
+last snapshot at or before k, which takes fewer than SNAPSHOT_INTERVAL moves.
+
+Each player can only play the houses on their own side of the board, so the
+player who started is known from the first move, and the player who made any
+move is known from the house played, without replaying. Games played under
+older rules (see kalah.RULES_VERSION) may not replay under the current ones;
+replaying them raises ValueError or gives the wrong states.
+"""
+import kalah
+
+SNAPSHOT_INTERVAL = 16
+
+
+def initial_state(history, variant):
+    """Return the game state at the start of a game with the given history,
+    or None if no moves have been made, since the first player is then
+    unknown."""
+    if not history:
+        return None
+    return kalah.newGame(north_starts=history[0] in variant.northern_houses,
+                         houses=variant.houses, seeds=variant.seeds)
+
+
+def snapshots(history, variant, interval=SNAPSHOT_INTERVAL):
+    """Return the game states after every interval moves of history: after
+    interval moves, 2 * interval moves, and so on."""
+    states = []
+    game_state = initial_state(history, variant)
+    for ply, house in enumerate(history, 1):
+        game_state = kalah.move(game_state, house, variant)
+        if ply % interval == 0:
+            states.append(game_state)
+    return states
+
+
+def state_at(history, ply, variant, snapshots=(),
+             interval=SNAPSHOT_INTERVAL):
+    """Return the game state after the first ply moves of history.
+
+    Args:
+        history: The houses played in the game, in order.
+        ply: The number of moves to replay, from 0 to len(history).
+        variant: The kalah.Variant being played.
+        snapshots: The game states after every interval moves, as returned by
+            snapshots. Any number of them may be given, starting from the
+            first, including none.
+        interval: The number of moves between snapshots.
+
+    Returns:
+        A game state of the form (next player, board), or None if no moves
+        have been made.
+
+    Raises:
+        IndexError: If ply is out of range.
+    """
+    if not 0 <= ply <= len(history):
+        raise IndexError("Ply must be between 0 and {}.".format(len(history)))
+    used = min(ply // interval, len(snapshots))
+    if used:
+        game_state = snapshots[used - 1]
+    else:
+        game_state = initial_state(history, variant)
+    for house in history[used * interval:ply]:
+        game_state = kalah.move(game_state, house, variant)
+    return game_state
+
+
+def players(history, variant):
+    """Return the player who made each move of history, as 'N' or 'S'.
+    Replaying the game, rather than only checking which side each house is
+    on, also checks that the history is a valid game."""
+    moves = []
+    game_state = initial_state(history, variant)
+    for house in history:
+        moves.append(game_state[0])
+        game_state = kalah.move(game_state, house, variant)
+    return moves
+
+
+def players_by_side(history, variant):
+    """Return the player who made each move of history, as 'N' or 'S', from
+    the side of the board of the house played. Unlike players, this does not
+    replay the game, so works for games played under older rules."""
+    return ['N' if house in variant.northern_houses else 'S'
+            for house in history]
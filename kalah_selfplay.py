@@ -0,0 +1,188 @@
+"""kalah_selfplay.py - Headless self-play for generating large numbers of
+complete Kalah games.
+
+Run from the command line:
+
+    python -m kalah_selfplay --games 100000 --north random --south greedy
+
+Games are split into chunks which are played across a multiprocessing pool.
+Each chunk is played with its own random number generator, seeded from the
+base seed and the chunk number, so that a run is reproducible however the
+chunks are scheduled. Each worker writes its chunk straight to its own file,
+so neither the workers nor the parent process hold more than one chunk of
+games in memory.
+
+Each output file contains one JSON object per line, of the form:
+
+    {"first": "N", "moves": [9, 2, ...], "scores": [south, north]}
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import kalah
+import kalah_ai
+
+
+def _valid_moves(game_state):
+    player, board = game_state
+    return [house for house in kalah.board_variant(board).player_houses[player]
+            if board[house]]
+
+
+def random_policy(rng):
+    """Return a policy which plays uniformly random valid moves."""
+    def policy(game_state):
+        return rng.choice(_valid_moves(game_state))
+    return policy
+
+
+def greedy_policy(rng):
+    """Return a policy which plays the move leaving the player furthest
+    ahead after one move, taking extra turns into account. Ties are broken
+    randomly."""
+    def policy(game_state):
+        player = game_state[0]
+        best_moves = []
+        best_score = None
+        for house in _valid_moves(game_state):
+            next_game_state = kalah.move(game_state, house)
+            score = kalah_ai.evaluate(next_game_state)
+            if next_game_state[0] != player:
+                score = -score
+            if best_score is None or score > best_score:
+                best_moves = [house]
+                best_score = score
+            elif score == best_score:
+                best_moves.append(house)
+        return rng.choice(best_moves)
+    return policy
+
+
+def search_policy(rng, max_depth=6):
+    """Return a policy which plays the move chosen by a fixed depth
+    alpha-beta search. The depth is fixed, rather than the search time, so
+    that games are reproducible."""
+    player = kalah_ai.AlphaBetaPlayer(time_limit=float('inf'),
+                                      max_depth=max_depth)
+    return player.choose_move
+
+POLICIES = {
+    'random': random_policy,
+    'greedy': greedy_policy,
+    'search': search_policy,
+}
+
+
+def play_game(north_policy, south_policy, north_starts,
+              variant=kalah.get_variant()):
+    """Play a complete game of the given Variant between two policies.
+
+    Returns:
+        A dict giving the first player, the list of moves played and the
+        final scores in the form [south, north].
+    """
+    game_state = kalah.newGame(north_starts, variant.houses, variant.seeds)
+    policies = {'N': north_policy, 'S': south_policy}
+    moves = []
+    final_scores = kalah.winner(game_state, variant)
+    while not final_scores:
+        house = policies[game_state[0]](game_state)
+        game_state = kalah.move(game_state, house, variant)
+        moves.append(house)
+        final_scores = kalah.winner(game_state, variant)
+    return {'first': 'N' if north_starts else 'S',
+            'moves': moves,
+            'scores': list(final_scores)}
+
+
+def play_chunk(job):
+    """Play one chunk of games and write them to disk.
+
+    Args:
+        job: A tuple of the form (path, number of games, north policy name,
+            south policy name, seed, (houses, seeds) variant).
+
+    Returns:
+        A tuple of the form (path, number of games, south wins, north wins,
+        draws).
+    """
+    path, games, north_name, south_name, seed, variant = job
+    variant = kalah.get_variant(*variant)
+    rng = random.Random(seed)
+    north_policy = POLICIES[north_name](rng)
+    south_policy = POLICIES[south_name](rng)
+    wins = {'S': 0, 'N': 0, 'draw': 0}
+    with open(path, 'w') as output:
+        for _ in range(games):
+            game = play_game(north_policy, south_policy,
+                             rng.random() < 0.5, variant)
+            south_score, north_score = game['scores']
+            if south_score > north_score:
+                wins['S'] += 1
+            elif north_score > south_score:
+                wins['N'] += 1
+            else:
+                wins['draw'] += 1
+            output.write(json.dumps(game, separators=(',', ':')))
+            output.write('\n')
+    return (path, games, wins['S'], wins['N'], wins['draw'])
+
+
+def run(games, chunk_size, north_name, south_name, out_dir, seed=0,
+        processes=None, variant=kalah.DEFAULT_VARIANT):
+    """Play games across a pool of worker processes, writing one file per
+    chunk of games to out_dir. variant is a tuple of the form
+    (houses, seeds).
+
+    Yields:
+        The result of play_chunk for each chunk, as chunks complete.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    jobs = []
+    for chunk, first_game in enumerate(range(0, games, chunk_size)):
+        path = os.path.join(out_dir, 'games-{:05d}.jsonl'.format(chunk))
+        jobs.append((path, min(chunk_size, games - first_game),
+                     north_name, south_name, (seed << 32) + chunk, variant))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(play_chunk, jobs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--north', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--south', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--out', default='selfplay')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--houses', type=int, default=kalah.DEFAULT_VARIANT[0])
+    parser.add_argument('--seeds', type=int, default=kalah.DEFAULT_VARIANT[1])
+    args = parser.parse_args()
+
+    start = time.time()
+    totals = [0, 0, 0, 0]
+    for result in run(args.games, args.chunk_size, args.north, args.south,
+                      args.out, args.seed, args.processes,
+                      (args.houses, args.seeds)):
+        totals = [total + n for total, n in zip(totals, result[1:])]
+        print "wrote {} ({} games)".format(result[0], result[1])
+    elapsed = time.time() - start
+    print "{:,} games in {:.1f}s ({:,.0f} games/sec)".format(
+        totals[0], elapsed, totals[0] / elapsed)
+    print "South wins: {:,}, North wins: {:,}, draws: {:,}".format(
+        *totals[1:])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""loadtest.py - Load test of many games finishing at once for one user.
+
+Runs against the App Engine SDK's local service stubs, so it needs the SDK:
+
+    python loadtest.py --sdk /path/to/google_appengine [--games N]
+        [--threads T]
+
+One user plays every game, each of which is one move from its end. Threads
+finish the games concurrently in two ways: by updating both users' wins,
+losses and draws in the move's transaction, as Game.move used to, and with
+Game.move, which logs GameResults to be folded into the users' totals
+afterwards. Each run reports completed games per second, the number of
+transactions retried because another transaction changed the same entity
+group first, and the user's recorded wins, losses and draws, checking that
+South's win in every finished game was counted.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+
+def _setup(sdk):
+    """Put the SDK on the path and activate the local service stubs.
+
+    Returns:
+        The activated testbed.Testbed.
+    """
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # Queries see every write, as they would once the datastore has caught up
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    return bed
+
+
+def _new_games(count):
+    """Create a user who is South in count games against different opponents.
+    In each game South is to move, with one seed left in house 5, so moving
+    it ends the game, which South wins by 19 to 17.
+
+    Returns:
+        A tuple of the form (user key, list of game keys).
+    """
+    from google.appengine.ext import ndb
+    from models import Game, User
+
+    board = (0, 0, 0, 0, 0, 1, 18, 1, 1, 1, 1, 1, 1, 11)
+    user = User(name='heavy')
+    user.put()
+    opponents = [User(name='opponent{}'.format(i)) for i in range(count)]
+    ndb.put_multi(opponents)
+    games = [Game(north_user=opponent.key, south_user=user.key,
+                  north_user_name=opponent.name, south_user_name=user.name,
+                  game_state=('S', board))
+             for opponent in opponents]
+    return user.key, ndb.put_multi(games)
+
+
+def _finish_updating_users(game, house):
+    """Finish a game the way Game.move did before results were logged,
+    updating both Users in the move's transaction."""
+    from google.appengine.ext import ndb
+    import kalah
+
+    @ndb.transactional(xg=True)
+    def move():
+        new_game_state = kalah.move(game.game_state, house, game.variant)
+        game.history.append(house)
+        final_scores = kalah.winner(new_game_state, game.variant)
+        game.game_over = True
+        game.south_final_score, game.north_final_score = final_scores
+        north_result = cmp(final_scores[1], final_scores[0])
+        game.north_user.get().record_result(north_result)
+        game.south_user.get().record_result(-north_result)
+        game.game_state = new_game_state
+        game.put()
+    move()
+
+
+def _finish_logging_results(game, house):
+    """Finish a game with Game.move."""
+    game.move(house)
+
+
+def run(finish, game_keys, threads):
+    """Finish every game, sharing them out between threads.
+
+    Args:
+        finish: A function taking a Game and a house, which makes the move.
+        game_keys: Keys of the games to finish.
+        threads: The number of threads to use.
+
+    Returns:
+        A dict giving the number of games finished, failed transactions,
+        retried transactions and games finished per second.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_errors
+
+    lock = threading.Lock()
+    counts = {'commits': 0, 'finished': 0, 'failed': 0}
+
+    def count_commit(service, call, request, response):
+        if (service, call) == ('datastore_v3', 'Commit'):
+            with lock:
+                counts['commits'] += 1
+
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('loadtest', count_commit)
+
+    def worker(keys):
+        for key in keys:
+            try:
+                finish(key.get(), 5)
+                outcome = 'finished'
+            except datastore_errors.TransactionFailedError:
+                outcome = 'failed'
+            with lock:
+                counts[outcome] += 1
+
+    start = time.time()
+    workers = [threading.Thread(target=worker, args=(game_keys[i::threads],))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    hooks.Clear()
+    # Every attempt at a transaction ends in a commit, whether or not it
+    # succeeds, and Game.move makes no other commits
+    attempts = counts['finished'] + counts['failed']
+    return {'finished': counts['finished'],
+            'failed': counts['failed'],
+            'retries': counts['commits'] - attempts,
+            'games_per_second': counts['finished'] / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the google_appengine SDK directory')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    for name, finish in (('update users', _finish_updating_users),
+                         ('log results', _finish_logging_results)):
+        bed = _setup(args.sdk)
+        try:
+            from models import User
+            user_key, game_keys = _new_games(args.games)
+            result = run(finish, game_keys, args.threads)
+            if finish is _finish_logging_results:
+                User.fold_results(user_key)
+            user = user_key.get()
+            print ("{:<14}{:>5} finished  {:>4} failed  {:>5} retries  "
+                   "{:>8.1f} games/sec  {} wins  {} losses  {} draws").format(
+                       name, result['finished'], result['failed'],
+                       result['retries'], result['games_per_second'],
+                       user.wins, user.losses, user.draws)
+            # South wins every game, so each one finished is one win
+            expected = args.games - result['failed']
+            assert user.wins == expected, (
+                '{} wins recorded, expected {}'.format(user.wins, expected))
+        finally:
+            bed.deactivate()
+
+if __name__ == "__main__":
+    main()
@@ -2,70 +2,519 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import datetime
+import json
 import logging
+import os
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import KalahApi
 
-from utils import get_by_urlsafe
-from models import Game, User
+import kalah_export
+from models import Game, User, RankingShard, RankingState, RankingsEmail,\
+    RankingsEmailBatch, GameExport, GameExportChunk, REMINDER_QUEUE,\
+    REBUILD_FOLD_DELAY, USER_KEYS, count_reminders_async,\
+    get_reminder_counts
+from utils import ENDPOINT_STATS
+
+# Number of Games or Users rewritten by each migration task
+MIGRATION_BATCH_SIZE = 200
+# Seconds for which reminders are leased while being sent, and the most
+# reminders sent in one email
+REMINDER_LEASE_SECONDS = 60
+REMINDER_LEASE_LIMIT = 1000
+# Number of users in the emailed rankings table, users sent the rankings
+# email by each task, and seconds after which a run which has not progressed
+# is resumed by the next cron job
+RANKINGS_EMAIL_SIZE = 100
+RANKINGS_BATCH_SIZE = 100
+RANKINGS_STALL_SECONDS = 3600
+# Seconds before a rankings rebuild counts its first batch of Users, so that
+# the query finds Users created just before it started, and after which a
+# rebuild which has not progressed can be resumed
+REBUILD_START_DELAY = 60
+REBUILD_STALL_SECONDS = 600
+# Number of Games in each chunk of a game export
+EXPORT_CHUNK_SIZE = 1000
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def post(self):
-        """Send a reminder email to a user once their opponent has moved
-        using push queue"""
+        """Send a user one email reminding them of every game in which it
+        has become their turn recently, using push queue. Games in which they
+        have moved since are left out."""
         app_id = app_identity.get_application_id()
-        game = get_by_urlsafe(self.request.get('urlsafe_key'), Game)
-        # Find out who has the next turn
-        if game.game_state[0] == 'N':
-            user = game.north_user.get()
-            opponent = game.south_user.get()
-        else:
-            user = game.south_user.get()
-            opponent = game.north_user.get()
+        urlsafe_key = self.request.get('user_key')
+        if not urlsafe_key:
+            # Tasks queued before reminders were grouped by user carry no
+            # user_key; drop them rather than let them retry forever
+            logging.warning('Dropping reminder email task without a user_key')
+            return
+        user_key = ndb.Key(urlsafe=urlsafe_key)
+        queue = taskqueue.Queue(REMINDER_QUEUE)
+        reminders = queue.lease_tasks_by_tag(REMINDER_LEASE_SECONDS,
+                                             REMINDER_LEASE_LIMIT,
+                                             tag=user_key.urlsafe())
+        # The number of moves in each game when its latest reminder was sent
+        move_counts = {}
+        for reminder in reminders:
+            urlsafe_key, move_count = reminder.payload.rsplit(':', 1)
+            move_counts[urlsafe_key] = max(move_counts.get(urlsafe_key, 0),
+                                           int(move_count))
+        games = ndb.get_multi([ndb.Key(urlsafe=urlsafe_key)
+                               for urlsafe_key in move_counts])
+        waiting = [game for game in games
+                   if game and game.active and
+                   len(game.history) == move_counts[game.key.urlsafe()]]
+        Game.fill_user_names(waiting)
+        waiting_keys = set(game.key.urlsafe() for game in waiting)
+        skipped = sum(1 for reminder in reminders
+                      if reminder.payload.rsplit(':', 1)[0]
+                      not in waiting_keys)
+        count_reminders_async('skipped', skipped).get_result()
 
-        if user.email:
-            subject = 'Your turn to play, {}!'.format(user.name)
-            body = 'Hello {}, it\'s your turn to play in your game against {}!'
-            body = body.format(user.name, opponent.name)
+        user = user_key.get()
+        if waiting and user.email:
+            opponent_names = [game.south_user_name
+                              if game.north_user == user_key
+                              else game.north_user_name
+                              for game in waiting]
+            if len(waiting) == 1:
+                subject = 'Your turn to play, {}!'.format(user.name)
+                body = 'Hello {}, it\'s your turn to play in your game ' \
+                    'against {}!'.format(user.name, opponent_names[0])
+            else:
+                subject = 'Your turn to play in {} games, {}!'.format(
+                    len(waiting), user.name)
+                body = 'Hello {}, it\'s your turn to play in your games ' \
+                    'against:\n\n'.format(user.name)
+                body += ''.join('{}\n'.format(name)
+                                for name in opponent_names)
             # This will send test emails, the arguments to send_mail are:
             # from, to, subject, body
             mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
                            user.email,
                            subject,
                            body)
+            count_reminders_async('sent').get_result()
+        queue.delete_tasks(reminders)
+        logging.info('Reminders: %s', get_reminder_counts())
 
 
 class SendRankingEmail(webapp2.RequestHandler):
     def get(self):
-        """Send an email to all users giving the user rankings"""
+        """Send an email to all users giving the user rankings. The rankings
+        table is rendered once, then tasks walk through the users with email
+        addresses in batches, queuing a task to send each batch. If the last
+        run has stalled, it is resumed instead."""
+        stalled = datetime.datetime.now() - datetime.timedelta(
+            seconds=RANKINGS_STALL_SECONDS)
+        last_run = RankingsEmail.query().order(-RankingsEmail.started).get()
+        if last_run and last_run.updated < stalled:
+            for batch in RankingsEmailBatch.query(
+                    RankingsEmailBatch.done == False,
+                    ancestor=last_run.key):
+                if batch.updated < stalled:
+                    taskqueue.add(url='/tasks/send_rankings_batch',
+                                  params={'batch_key': batch.key.urlsafe()})
+        if last_run and not last_run.done:
+            if last_run.updated < stalled:
+                taskqueue.add(url='/tasks/walk_rankings_recipients',
+                              params={'run_key': last_run.key.urlsafe()})
+                logging.info('Resuming rankings email run %s', last_run.key)
+            return
+
+        run = RankingsEmail(
+            table=RankingsEmail.render_table(RANKINGS_EMAIL_SIZE))
+        run.put()
+        taskqueue.add(url='/tasks/walk_rankings_recipients',
+                      params={'run_key': run.key.urlsafe()})
+
+
+class WalkRankingsRecipients(webapp2.RequestHandler):
+    def post(self):
+        """Queue a task to send the rankings email to the next batch of
+        users, then queue this task again for the batch after, using push
+        queue"""
+        run = ndb.Key(urlsafe=self.request.get('run_key')).get()
+        if run.done:
+            return
+        keys, next_cursor, more = User.query(User.email != None).fetch_page(
+            RANKINGS_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=run.cursor))
+        self.checkpoint(run.key, run.cursor, keys,
+                        next_cursor.urlsafe() if next_cursor else None,
+                        more and next_cursor is not None)
+
+    @staticmethod
+    @ndb.transactional
+    def checkpoint(run_key, cursor, keys, next_cursor, more):
+        """Record that the batch of users starting at cursor has been queued,
+        unless this was already done by an earlier attempt."""
+        run = run_key.get()
+        if run.done or run.cursor != cursor:
+            return
+        batch = RankingsEmailBatch(parent=run_key, users=keys)
+        batch.put()
+        run.cursor = next_cursor
+        run.done = not more
+        run.put()
+        # Queued only if the transaction succeeds
+        taskqueue.add(url='/tasks/send_rankings_batch',
+                      params={'batch_key': batch.key.urlsafe()},
+                      transactional=True)
+        if more:
+            taskqueue.add(url='/tasks/walk_rankings_recipients',
+                          params={'run_key': run_key.urlsafe()},
+                          transactional=True)
+
+
+class SendRankingsBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the rankings email to a batch of users, recording each email
+        sent so that a retried task does not send it again, using push
+        queue"""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None).fetch()
-        rankings = User.query().order(-User.win_loss_ratio, -User.draws)
-        rankings = rankings.fetch()
-
-        # Create rankings table
-        rankings_format = "{:<15}{:<15}\n"
-        header = rankings_format.format("Name", "Win/loss ratio")
-        lines = [rankings_format.format(user.name, user.win_loss_ratio)
-                 for user in rankings]
-        table = header + ''.join(lines)
-
-        # Email users
+        batch = ndb.Key(urlsafe=self.request.get('batch_key')).get()
+        if batch.done:
+            return
+        run = batch.key.parent().get()
+        users = ndb.get_multi(batch.users[batch.sent:])
+        start = time.time()
         for user in users:
-            subject = 'Kalah rankings'
-            body = "Hello {}, here is an update on Kalah rankings:\n\n"
-            body = body.format(user.name)
-            body += table
+            if user and user.email:
+                subject = 'Kalah rankings'
+                body = "Hello {}, here is an update on Kalah rankings:\n\n"
+                body = body.format(user.name)
+                body += run.table
+
+                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                               user.email,
+                               subject,
+                               body)
+            batch.sent += 1
+            batch.put()
+        batch.done = True
+        batch.put()
+
+        elapsed = time.time() - start
+        total = ndb.get_context().memcache_incr(
+            'rankings_email:{}'.format(run.key.id()), len(users),
+            initial_value=0).get_result()
+        run_elapsed = (datetime.datetime.now() - run.started).total_seconds()
+        logging.info('Sent %d rankings emails at %.1f emails/sec; %s sent '
+                     'in this run at %.1f emails/sec', len(users),
+                     len(users) / elapsed if elapsed else 0.0, total,
+                     (total or 0) / run_elapsed)
+
+
+class MigrateGameStates(webapp2.RequestHandler):
+    def get(self):
+        """Start rewriting every Game so that its game state is stored in
+        the compact encoding rather than pickled, and so that the user names
+        and players properties used by game listings are filled in."""
+        taskqueue.add(url='/tasks/migrate_game_states')
+        self.response.write('Game state migration started.')
+
+    def post(self):
+        """Rewrite one batch of Games, then queue a task for the next batch
+        using push queue"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        # The user names are looked up first, since each transaction can
+        # only read its Game's entity group
+        games = [game for game in ndb.get_multi(keys) if game]
+        Game.fill_user_names(games)
+        futures = [self.migrate_async(game) for game in games]
+        for future in futures:
+            future.get_result()
+        logging.info('Migrated game states of %d Games', len(games))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_game_states',
+                          params={'cursor': next_cursor.urlsafe()})
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def migrate_async(copy):
+        """Rewrite a Game as stored, filling in the user names found for
+        copy, so that a move made since copy was read is not undone."""
+        game = yield copy.key.get_async()
+        if game is None:
+            return
+        # ndb writes values back unchanged unless they have been decoded
+        game.game_state = game.game_state
+        if game.north_user_name is None:
+            game.north_user_name = copy.north_user_name
+        if game.south_user_name is None:
+            game.south_user_name = copy.south_user_name
+        yield game.put_async()
+
+
+class UpdateUserNames(webapp2.RequestHandler):
+    def post(self):
+        """Update the copies of a renamed User's name stored on one batch of
+        their Games, then queue a task for the next batch using push
+        queue"""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        # The current name is used, in case the User was renamed again
+        name = user_key.get().name
+        changed, next_cursor, more = Game.update_user_name(
+            user_key, name, MIGRATION_BATCH_SIZE, cursor)
+        logging.info('Updated the name %s on %d Games', name, changed)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/update_user_names',
+                          params={'user_key': user_key.urlsafe(),
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class FoldResults(webapp2.RequestHandler):
+    def post(self):
+        """Add a User's results from finished games to their totals, then
+        queue this task again if any are still waiting, using push queue"""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        result_keys = [ndb.Key(urlsafe=urlsafe)
+                       for urlsafe in self.request.get_all('result_key')]
+        folded = User.fold_results(user_key, result_keys)
+        logging.info('Folded %d results for %s', folded, user_key)
+        if User.has_waiting_results(user_key):
+            # Nothing is folded until a rankings rebuild finishes
+            if RankingState.current_async().get_result().rebuilding:
+                User.schedule_fold_async(
+                    [user_key], countdown=REBUILD_FOLD_DELAY).get_result()
+            else:
+                User.schedule_fold_async([user_key]).get_result()
+
+
+class SweepWaitingResults(webapp2.RequestHandler):
+    def get(self):
+        """Queue tasks to fold any results left waiting, such as when a
+        fold task could not be queued after a game finished, using cron"""
+        users = User.schedule_waiting_folds()
+        logging.info('Queued folds for %d Users with waiting results', users)
+
+
+class RebuildRankings(webapp2.RequestHandler):
+    def get(self):
+        """Start recounting the Users in each rank bucket into the next
+        generation of RankingShards, rewriting every User so that their rank
+        bucket is indexed, or resume a rebuild which has stalled. The live
+        counts are used until the new ones are complete. Results of games
+        finished meanwhile wait to be folded in until then, and Users
+        created meanwhile are counted in both generations."""
+        self.response.write(self.start())
+
+    @staticmethod
+    @ndb.transactional
+    def start():
+        """Mark the rebuild as running and queue its first batch, returning
+        a message for the admin."""
+        state = RankingState.current_async().get_result()
+        if state.rebuilding:
+            stalled = datetime.datetime.now() - datetime.timedelta(
+                seconds=REBUILD_STALL_SECONDS)
+            if state.updated and state.updated >= stalled:
+                return 'Rankings rebuild already running.'
+            taskqueue.add(url='/tasks/rebuild_rankings', transactional=True)
+            return 'Rankings rebuild resumed.'
+        state.rebuilding = True
+        state.cursor = None
+        state.put()
+        taskqueue.add(url='/tasks/rebuild_rankings',
+                      countdown=REBUILD_START_DELAY, transactional=True)
+        return 'Rankings rebuild started.'
+
+    def post(self):
+        """Count the next batch of Users, then queue this task again for the
+        batch after, using push queue. Once the rebuild is done, delete the
+        RankingShards it replaced."""
+        state = RankingState.current_async().get_result()
+        if not state.rebuilding:
+            if state.generation:
+                ndb.delete_multi(RankingShard.all_keys(state.generation - 1))
+            return
+        keys, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=Cursor(urlsafe=state.cursor),
+            keys_only=True)
+        futures = [self.rewrite_user_async(key) for key in keys]
+        users = [user for user in [future.get_result() for future in futures]
+                 if user and user.ranked_generation != state.next_generation]
+        if self.checkpoint(state.cursor, users,
+                           next_cursor.urlsafe() if next_cursor else None,
+                           more and next_cursor is not None):
+            logging.info('Counted %d Users in rank buckets', len(users))
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def rewrite_user_async(key):
+        """Rewrite a User as stored, so that their rank bucket is indexed,
+        without undoing changes made since the batch was listed.
+        Returns a Future for the User, or for None if they have gone."""
+        user = yield key.get_async()
+        if user:
+            yield user.put_async()
+        raise ndb.Return(user)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def checkpoint(cursor, users, next_cursor, more):
+        """Add the batch of Users starting at cursor to the new counts, and
+        queue the next batch, unless this was already done by an earlier
+        attempt. After the last batch, make the new counts live. Returns
+        whether the batch was counted."""
+        state = RankingState.current_async().get_result()
+        if not state.rebuilding or state.cursor != cursor:
+            return False
+        shard = RankingShard.random_shard_async(
+            state.next_generation).get_result()
+        for user in users:
+            shard.move_user(None, user.rank_bucket)
+        state.cursor = next_cursor
+        if not more:
+            state.generation = state.next_generation
+            state.rebuilding = False
+            state.cursor = None
+        ndb.put_multi([state, shard])
+        # Queued only if the transaction succeeds
+        taskqueue.add(url='/tasks/rebuild_rankings', transactional=True)
+        return True
+
+
+class ExportGames(webapp2.RequestHandler):
+    def get(self):
+        """Start exporting every finished Game to a kalah_export archive,
+        one chunk per task, or download a finished export given by
+        export_key, one part at a time."""
+        if self.request.get('export_key'):
+            self.download(ndb.Key(urlsafe=self.request.get('export_key')),
+                          self.request.get('part'))
+            return
+        export = GameExport()
+        export.put()
+        taskqueue.add(url='/tasks/export_games',
+                      params={'export_key': export.key.urlsafe()})
+        self.response.write('Game export started: {}'.format(
+            export.key.urlsafe()))
+
+    def post(self):
+        """Export the next page of finished Games as a chunk, then queue a
+        task for the next page, using push queue"""
+        export = ndb.Key(urlsafe=self.request.get('export_key')).get()
+        if export.done:
+            return
+        start = time.time()
+        games, next_cursor, more = Game.query(
+            Game.game_over == True).fetch_page(
+                EXPORT_CHUNK_SIZE, start_cursor=Cursor(urlsafe=export.cursor))
+        Game.fill_user_names(games)
+        data = kalah_export.encode_chunk([game.to_export_record()
+                                          for game in games])
+        self.checkpoint(export.key, export.cursor, data, len(games),
+                        next_cursor.urlsafe() if next_cursor else None,
+                        more and next_cursor is not None)
+        elapsed = time.time() - start
+        logging.info('Exported %d Games in %d bytes at %.0f games/sec',
+                     len(games), len(data),
+                     len(games) / elapsed if elapsed else 0.0)
+
+    @staticmethod
+    @ndb.transactional
+    def checkpoint(export_key, cursor, data, games, next_cursor, more):
+        """Store the chunk of Games starting at cursor, unless an earlier
+        attempt already did."""
+        export = export_key.get()
+        if export.done or export.cursor != cursor:
+            return
+        export.chunks += 1
+        export.chunk_sizes.append(len(data))
+        export.games += games
+        export.cursor = next_cursor
+        export.done = not more
+        ndb.put_multi([export, GameExportChunk(parent=export_key,
+                                               id=export.chunks, data=data)])
+        if more:
+            taskqueue.add(url='/tasks/export_games',
+                          params={'export_key': export_key.urlsafe()},
+                          transactional=True)
+
+    def download(self, export_key, part):
+        """Write one part of a finished export's kalah_export archive, or,
+        if no part is given, the number of parts. The archive is the parts
+        joined in order: its header, each chunk, then its index and footer.
+        Each part is at most one chunk, so the archive is never held in
+        memory, however many Games it has."""
+        export = export_key.get()
+        if not export or not export.done:
+            self.response.set_status(404)
+            self.response.write('No finished export with that key.')
+            return
+        parts = export.chunks + 2
+        if not part:
+            self.response.write(
+                'Export of {} Games in {} parts. Download each with '
+                '&part=0 to &part={} and join them in order.'.format(
+                    export.games, parts, parts - 1))
+            return
+        if not part.isdigit() or int(part) >= parts:
+            self.response.set_status(404)
+            self.response.write('No such part.')
+            return
+        part = int(part)
+        self.response.headers['Content-Type'] = 'application/octet-stream'
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename=games.kex.{}'.format(part)
+        if part == 0:
+            self.response.write(kalah_export.MAGIC)
+        elif part <= export.chunks:
+            chunk = GameExportChunk.get_by_id(part, parent=export_key)
+            self.response.write(chunk.data)
+        else:
+            sizes = export.chunk_sizes
+            if len(sizes) != export.chunks:
+                # Exports from before chunk sizes were recorded
+                sizes = [len(GameExportChunk.get_by_id(
+                    number, parent=export_key, use_cache=False,
+                    use_memcache=False).data)
+                         for number in range(1, export.chunks + 1)]
+            offsets = []
+            position = len(kalah_export.MAGIC)
+            for size in sizes:
+                offsets.append(position)
+                position += size
+            self.response.write(kalah_export.archive_end(offsets, position))
+
+
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Show, as JSON, percentiles of the time taken and API calls made
+        by recent requests to each endpoint handled by this instance, and
+        the hit rates of this instance's caches. Each instance keeps its own
+        statistics; the endpoint_stats log lines cover every request."""
+        stats = {
+            'instance': os.environ.get('INSTANCE_ID'),
+            'endpoints': ENDPOINT_STATS.percentiles(),
+            'user_key_cache_hit_rate': USER_KEYS.hit_rate(),
+            'game_form_cache_hit_rate': Game.form_cache_hit_rate(),
+            'reminders': get_reminder_counts()}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
 
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
 
 app = webapp2.WSGIApplication([
     ('/tasks/send_reminder', SendReminderEmail),
-    ('/crons/send_rankings_update', SendRankingEmail)
+    ('/tasks/migrate_game_states', MigrateGameStates),
+    ('/tasks/rebuild_rankings', RebuildRankings),
+    ('/tasks/fold_results', FoldResults),
+    ('/tasks/update_user_names', UpdateUserNames),
+    ('/tasks/walk_rankings_recipients', WalkRankingsRecipients),
+    ('/tasks/export_games', ExportGames),
+    ('/tasks/send_rankings_batch', SendRankingsBatch),
+    ('/crons/send_rankings_update', SendRankingEmail),
+    ('/crons/sweep_waiting_results', SweepWaitingResults),
+    ('/admin/endpoint_stats', EndpointStats)
 ], debug=True)
@@ -2,11 +2,142 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import cPickle as pickle
+import logging
 import random
+import time
+from collections import Counter
 # from datetime import date
-from protorpc import messages
+from protorpc import messages, protobuf
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import kalah
+import kalah_replay
+from utils import LRUCache, timed
+
+# Number of Games returned per page by default, and at most
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# In-process cache of User keys by user name, in front of memcache and the
+# UserName index
+USER_KEY_CACHE_SIZE = 10000
+USER_KEYS = LRUCache(USER_KEY_CACHE_SIZE)
+
+# Users are counted in RANK_BUCKETS buckets, in ranking order, so that a
+# User's rank can be found without counting every User ahead of them. Users
+# with a win_loss_ratio of exactly 0 or 1, which includes every new User,
+# are bucketed by their number of draws, up to DRAW_BUCKETS - 1, so that
+# all of the Users in such a bucket are tied. Other Users are bucketed by
+# win_loss_ratio, in RATIO_BUCKETS buckets. The counts are spread over
+# RANKING_SHARDS entities to spread the writes.
+DRAW_BUCKETS = 100
+RATIO_BUCKETS = 1000
+RANK_BUCKETS = 2 * DRAW_BUCKETS + RATIO_BUCKETS
+RANKING_SHARDS = 20
+
+# Seconds between a game finishing and its results being added to the
+# players' totals, during which other results for them are collected too
+FOLD_DELAY = 5
+# Most Users whose waiting results are folded by each sweep
+FOLD_SWEEP_LIMIT = 1000
+# Seconds between attempts to fold a User's results while the rank bucket
+# counts are being rebuilt, during which nothing is folded
+REBUILD_FOLD_DELAY = 60
+# Seconds that a reminder waits before being sent, so that it can be sent in
+# one email together with the recipient's other reminders in that time
+REMINDER_DELAY = 300
+# Pull queue holding reminders waiting to be sent, tagged by recipient
+REMINDER_QUEUE = 'reminders'
+# Names of the memcache counters of reminders: reminders queued, reminders
+# added to an email already due to be sent, emails sent, and reminders not
+# sent because the player had moved or the game had ended
+REMINDER_COUNTERS = ('enqueued', 'coalesced', 'sent', 'skipped')
+
+# GameResults added to a User's totals in each transaction, leaving room for
+# the User, a RankingShard and the RankingState within the limit of 25
+# entity groups
+RESULTS_PER_FOLD = 22
+
+# Hits and misses of the memcache cache of GameForms, in this instance
+GAME_FORM_CACHE_STATS = Counter()
+
+# Attempts at compare-and-set when replacing a cached GameForm or version,
+# before giving up to a concurrent writer
+GAME_FORM_CACHE_RETRIES = 3
+
+
+def _rank_bucket(win_loss_ratio, draws):
+    """Return the rank bucket for a win to loss ratio between 0 and 1 and a
+    number of draws."""
+    if win_loss_ratio == 0:
+        return min(draws, DRAW_BUCKETS - 1)
+    if win_loss_ratio == 1:
+        return DRAW_BUCKETS + RATIO_BUCKETS + min(draws, DRAW_BUCKETS - 1)
+    return DRAW_BUCKETS + min(int(win_loss_ratio * RATIO_BUCKETS),
+                              RATIO_BUCKETS - 1)
+
+
+def _tied_bucket(bucket):
+    """Return whether every User in a rank bucket is tied."""
+    return (bucket < DRAW_BUCKETS - 1 or
+            DRAW_BUCKETS + RATIO_BUCKETS <= bucket < RANK_BUCKETS - 1)
+
+
+def _encode_rankings_cursor(bucket, position, cursor):
+    """Return the cursor string given by User.rankings for the next page,
+    from the rank bucket its query starts at, the number of Users before
+    the page, and the query's Cursor."""
+    return '{}:{}:{}'.format(bucket, position, cursor.urlsafe())
+
+
+def _decode_rankings_cursor(rankings_cursor):
+    """Return the (bucket, position, Cursor) encoded by
+    _encode_rankings_cursor.
+
+    Raises:
+        ValueError: If the string is malformed.
+    """
+    try:
+        bucket, position, urlsafe = rankings_cursor.split(':', 2)
+        return int(bucket), int(position), Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+class GameChangedError(Exception):
+    """Raised by Game.move when the stored Game has changed since it was
+    read, so that the move may no longer be allowed. The game attribute
+    holds the Game as stored."""
+
+    def __init__(self, game):
+        super(GameChangedError, self).__init__('Game has changed.')
+        self.game = game
+
+# - - - Custom properties - - - - - - - - - - - - -
+
+
+class GameStateProperty(ndb.BlobProperty):
+    """Stores a Kalah game state of the form (next player, board) in the
+    compact form given by kalah.encode_state.
+
+    Game states used to be stored with an ndb.PickleProperty, so values which
+    are still pickled are also read. ndb only decodes a value when it is
+    first accessed."""
+
+    def _validate(self, value):
+        if not isinstance(value, tuple) or len(value) != 2:
+            raise TypeError('Expected a (player, board) tuple, got %r' %
+                            (value,))
+
+    def _to_base_type(self, value):
+        return kalah.encode_state(value)
+
+    def _from_base_type(self, value):
+        if value[0] in 'NS':
+            return kalah.decode_state(value)
+        return pickle.loads(value)
 
 # - - - Datastore models - - - - - - - - - - - - -
 
@@ -23,19 +154,46 @@ class User(ndb.Model):
         lambda self: ((float(self.wins) / (self.wins + self.losses))
                       if self.wins + self.losses > 0
                       else 0.0))
+    rank_bucket = ndb.ComputedProperty(
+        lambda self: _rank_bucket(self.win_loss_ratio, self.draws))
+    # Set on Users created during a rebuild of the rank bucket counts to the
+    # generation being built, which counts them already
+    ranked_generation = ndb.IntegerProperty(indexed=False)
+
+    def get_games(self, active_only=True, page_size=DEFAULT_PAGE_SIZE,
+                  cursor=None, summary_only=False):
+        """Gets a page of a user's games, by default only those which
+        have not finished or been canceled.
 
-    def get_games(self, active_only=True):
-        """Gets a user's games, by default only those which
-        have not finished or been canceled."""
-        qry = Game.query(ndb.OR(Game.north_user == self.key,
-                                Game.south_user == self.key))
+        Args:
+            active_only: Whether to leave out finished and canceled games.
+            page_size: The maximum number of games to return.
+            cursor: A Cursor marking where the page starts, or None for the
+                first page.
+            summary_only: If True, only the properties needed for
+                Game.to_summary_form are loaded, using a projection query.
+
+        Returns:
+            A tuple of the form (games, next cursor, more).
+        """
+        qry = Game.query(Game.players == self.key)
         if active_only:
             qry = qry.filter(Game.active == True)
-        return qry.fetch()
+        projection = ((Game.north_user_name, Game.south_user_name,
+                       Game.game_over, Game.canceled)
+                      if summary_only else None)
+        return qry.fetch_page(page_size, start_cursor=cursor,
+                              projection=projection)
 
     def record_result(self, result):
         """Record win, loss or draw.
         A result of -1 represents a loss, 0 a draw, 1 a win"""
+        self.add_result(result)
+        self.put()
+
+    def add_result(self, result):
+        """Record win, loss or draw, without saving the User, so that it can
+        be saved together with other entities."""
         if result not in (-1, 0, 1):
             raise ValueError("Result must be -1, 0 or 1")
         elif result == -1:
@@ -44,68 +202,657 @@ class User(ndb.Model):
             self.draws += 1
         elif result == 1:
             self.wins += 1
-        self.put()
 
-    def to_ranking_form(self):
+    @classmethod
+    def create(cls, name, email=None):
+        """Create a User, and add them to the UserName index.
+
+        Raises:
+            ValueError: If a User with that name already exists.
+        """
+        # Also adds any existing User with the name to the index
+        if cls.get_by_name(name):
+            raise ValueError('A User with that name already exists.')
+        user = cls._create(name, email)
+        cls.forget_name(name)
+        return user
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _create(cls, name, email):
+        if UserName.get_by_id(name):
+            raise ValueError('A User with that name already exists.')
+        state = RankingState.current_async().get_result()
+        user = cls(name=name, email=email)
+        generations = [state.generation]
+        if state.rebuilding:
+            # Counted in the new RankingShards too, so the rebuild skips them
+            user.ranked_generation = state.next_generation
+            generations.append(state.next_generation)
+        user.put()
+        shards = [RankingShard.random_shard_async(generation).get_result()
+                  for generation in generations]
+        for shard in shards:
+            shard.move_user(None, user.rank_bucket)
+        ndb.put_multi([UserName(id=name, user=user.key)] + shards)
+        return user
+
+    @classmethod
+    def fold_results(cls, user_key, result_keys=()):
+        """Add a User's GameResults to their wins, losses and draws, deleting
+        the GameResults.
+
+        Args:
+            user_key: The key of the User.
+            result_keys: Keys of GameResults known to be waiting, which the
+                query for the User's GameResults may not find yet, since it
+                is eventually consistent.
+
+        Returns:
+            The number of GameResults added.
+        """
+        keys = GameResult.query(GameResult.user == user_key).fetch(
+            keys_only=True)
+        keys = list(set(keys) | set(result_keys))
+        folded = 0
+        for i in range(0, len(keys), RESULTS_PER_FOLD):
+            folded += cls._fold(user_key, keys[i:i + RESULTS_PER_FOLD])
+        return folded
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _fold(cls, user_key, result_keys):
+        state = RankingState.current_async().get_result()
+        if state.rebuilding:
+            # Left waiting until the rebuild has counted every User
+            return 0
+        entities = ndb.get_multi([user_key] + result_keys)
+        user = entities[0]
+        # GameResults which have gone were added by another fold
+        results = [result for result in entities[1:] if result]
+        if not results:
+            return 0
+        shard = RankingShard.random_shard_async(
+            state.generation).get_result()
+        old_bucket = user.rank_bucket
+        for result in results:
+            user.add_result(result.result)
+        shard.move_user(old_bucket, user.rank_bucket)
+        ndb.put_multi([user, shard])
+        ndb.delete_multi([result.key for result in results])
+        return len(results)
+
+    @classmethod
+    def has_waiting_results(cls, user_key):
+        """Returns whether any of a User's GameResults are waiting to be
+        folded."""
+        keys = GameResult.query(GameResult.user == user_key).fetch(
+            RESULTS_PER_FOLD, keys_only=True)
+        # The query may still find GameResults which have been deleted
+        return any(ndb.get_multi(keys))
+
+    @staticmethod
+    def schedule_fold_async(user_keys, results=(), countdown=FOLD_DELAY):
+        """Queue a task for each of the given Users to fold their results,
+        returning a Future.
+
+        Args:
+            user_keys: Keys of the Users.
+            results: GameResults just written for the Users, which the tasks
+                fold even if the query for each User's GameResults does not
+                find them yet.
+            countdown: Seconds before the results are folded.
+        """
+        tasks = [taskqueue.Task(
+            url='/tasks/fold_results',
+            params={'user_key': key.urlsafe(),
+                    'result_key': [result.key.urlsafe() for result in results
+                                   if result.user == key]},
+            countdown=countdown) for key in user_keys]
+        return taskqueue.Queue().add_async(tasks)
+
+    @classmethod
+    def schedule_waiting_folds(cls, limit=FOLD_SWEEP_LIMIT):
+        """Queue tasks to fold the results of Users with GameResults still
+        waiting, such as those left when a fold task could not be queued
+        after a game finished.
+
+        Returns:
+            The number of Users whose results will be folded.
+        """
+        waiting = GameResult.query(projection=[GameResult.user],
+                                   distinct=True).fetch(limit)
+        user_keys = [result.user for result in waiting]
+        if user_keys:
+            cls.schedule_fold_async(user_keys).get_result()
+        return len(user_keys)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Return the User with the given name, or None if there is none."""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Asynchronous version of get_by_name, returning a Future."""
+        key = yield cls.key_for_name_async(name)
+        if key is None:
+            raise ndb.Return(None)
+        user = yield key.get_async()
+        if user is None or user.name != name:
+            # The User was renamed after their key was cached
+            cls.forget_name(name)
+            user = None
+            key = yield cls._key_for_name_uncached_async(name)
+            if key is not None:
+                user = yield key.get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.tasklet
+    def key_for_name_async(cls, name):
+        """Look up the key of the User with the given name, in USER_KEYS,
+        then memcache, then the UserName index.
+
+        Returns:
+            A Future for the key, or for None if there is no such User.
+        """
+        if not name:
+            raise ndb.Return(None)
+        key = USER_KEYS.get(name)
+        if key is None:
+            context = ndb.get_context()
+            urlsafe = yield context.memcache_get(_user_key_memcache_key(name))
+            if urlsafe:
+                key = ndb.Key(urlsafe=urlsafe)
+            else:
+                key = yield cls._key_for_name_uncached_async(name)
+                if key is None:
+                    raise ndb.Return(None)
+                yield context.memcache_set(_user_key_memcache_key(name),
+                                           key.urlsafe())
+            USER_KEYS.put(name, key)
+        raise ndb.Return(key)
+
+    @classmethod
+    @ndb.tasklet
+    def _key_for_name_uncached_async(cls, name):
+        index = yield UserName.get_by_id_async(name)
+        if index:
+            raise ndb.Return(index.user)
+        # Users created before the index was added
+        key = yield cls.query(cls.name == name).get_async(keys_only=True)
+        if key:
+            yield UserName(id=name, user=key).put_async()
+        raise ndb.Return(key)
+
+    @classmethod
+    def forget_name(cls, name):
+        """Remove a user name from the caches of User keys."""
+        USER_KEYS.delete(name)
+        ndb.get_context().memcache_delete(
+            _user_key_memcache_key(name)).get_result()
+
+    def rename(self, name):
+        """Change the User's name, updating the UserName index, and queue a
+        task to update the copies of the name stored on their Games.
+
+        Raises:
+            ValueError: If a User with that name already exists.
+        """
+        if User.get_by_name(name):
+            raise ValueError('A User with that name already exists.')
+        old_name = self.name
+        self._rename(name)
+        User.forget_name(old_name)
+        User.forget_name(name)
+
+    @ndb.transactional(xg=True)
+    def _rename(self, name):
+        if UserName.get_by_id(name):
+            raise ValueError('A User with that name already exists.')
+        old_name = self.name
+        self.name = name
+        ndb.put_multi([self, UserName(id=name, user=self.key)])
+        ndb.Key(UserName, old_name).delete()
+        # Queued only if the rename succeeds
+        taskqueue.add(url='/tasks/update_user_names',
+                      params={'user_key': self.key.urlsafe()},
+                      transactional=True)
+
+    def to_ranking_form(self, rank=None):
         """Returns a UserRankingInfoForm with ranking info about the User."""
         form = UserRankingInfoForm()
         form.name = self.name
         form.win_loss_ratio = self.win_loss_ratio
+        form.rank = rank
         return form
 
+    def get_rank(self, bucket_counts=None):
+        """Return the User's rank: one more than the number of Users ahead
+        of them by win to loss ratio, then by number of draws.
+
+        Args:
+            bucket_counts: The result of RankingShard.bucket_counts, if it
+                has already been fetched.
+        """
+        if bucket_counts is None:
+            bucket_counts = RankingShard.bucket_counts()
+        bucket = self.rank_bucket
+        # Only Users in the same bucket need to be counted, unless they are
+        # all tied
+        ahead = sum(bucket_counts[bucket + 1:])
+        if _tied_bucket(bucket):
+            return ahead + 1
+        same_bucket = User.query(User.rank_bucket == bucket)
+        ahead += same_bucket.filter(
+            User.win_loss_ratio > self.win_loss_ratio).count()
+        ahead += same_bucket.filter(
+            User.win_loss_ratio == self.win_loss_ratio,
+            User.draws > self.draws).count()
+        return ahead + 1
+
     @classmethod
-    def rankings(cls):
+    def rankings(cls, limit=DEFAULT_PAGE_SIZE, offset=0, cursor=None):
         """Return UserRankingsForm ordering users by win to loss ratio,
-        with greater number of draws used to break ties."""
-        qry = cls.query().order(-cls.win_loss_ratio, -cls.draws)
-        return UserRankingsForm(rankings=[user.to_ranking_form()
-                                          for user in qry.fetch()])
+        with greater number of draws used to break ties.
+
+        Args:
+            limit: The maximum number of Users to return.
+            offset: The number of Users to skip from the top of the ranking.
+                Ignored if cursor is given.
+            cursor: The next_cursor of the previous page, to continue from
+                there.
+
+        Raises:
+            ValueError: If cursor is malformed.
+        """
+        bucket_counts = RankingShard.bucket_counts()
+        if cursor:
+            bucket, offset, start_cursor = _decode_rankings_cursor(cursor)
+            bucket_offset = 0
+        else:
+            # Skip whole buckets using their counts, rather than skipping
+            # over every User with the query. Only the Users skipped in the
+            # last bucket are skipped by the query; later pages continue
+            # from the cursor instead.
+            skipped = 0
+            bucket = RANK_BUCKETS - 1
+            while bucket > 0 and skipped + bucket_counts[bucket] <= offset:
+                skipped += bucket_counts[bucket]
+                bucket -= 1
+            start_cursor = None
+            bucket_offset = offset - skipped
+        qry = cls.query(cls.rank_bucket <= bucket).order(
+            -cls.rank_bucket, -cls.win_loss_ratio, -cls.draws)
+        users, next_cursor, more = qry.fetch_page(
+            limit, start_cursor=start_cursor, offset=bucket_offset)
+
+        forms = []
+        for i, user in enumerate(users):
+            previous = users[i - 1] if i else None
+            if previous and (previous.win_loss_ratio, previous.draws) == \
+                    (user.win_loss_ratio, user.draws):
+                rank = forms[-1].rank
+            elif i == 0 and offset:
+                # May be tied with Users on the previous page
+                rank = user.get_rank(bucket_counts)
+            else:
+                rank = offset + i + 1
+            forms.append(user.to_ranking_form(rank))
+        form = UserRankingsForm(rankings=forms)
+        if more and next_cursor:
+            form.next_cursor = _encode_rankings_cursor(
+                bucket, offset + len(users), next_cursor)
+        return form
+
+
+class GameResult(ndb.Model):
+    """A win, loss or draw waiting to be added to a User's totals by
+    User.fold_results. A result of -1 represents a loss, 0 a draw, 1 a win"""
+    user = ndb.KeyProperty(kind=User, required=True)
+    result = ndb.IntegerProperty(required=True, indexed=False)
+
+
+class RankingShard(ndb.Model):
+    """One share of the counts of Users in each rank bucket. The number of
+    Users in a bucket is the sum of its counts over every shard of the live
+    generation, given by RankingState. Rebuilding the counts writes a new
+    generation of shards, which replaces the old one once it is complete."""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def shard_key(cls, generation, number):
+        """Returns the key of a shard, numbered from 1, of a generation."""
+        # Shards from before the counts were rebuilt into new generations
+        if generation == 0:
+            return ndb.Key(cls, number)
+        return ndb.Key(cls, '{}-{}'.format(generation, number))
+
+    @classmethod
+    @ndb.tasklet
+    def random_shard_async(cls, generation):
+        """Returns a Future for a shard of a generation chosen at random,
+        for use in a transaction which then saves it."""
+        key = cls.shard_key(generation, random.randrange(RANKING_SHARDS) + 1)
+        shard = yield key.get_async()
+        if shard is None:
+            shard = cls(key=key, counts=[0] * RANK_BUCKETS)
+        # Shards from before the number of buckets changed, until the
+        # rankings are rebuilt
+        shard.counts.extend([0] * (RANK_BUCKETS - len(shard.counts)))
+        raise ndb.Return(shard)
+
+    @classmethod
+    def all_keys(cls, generation):
+        """Returns the keys of every shard of a generation."""
+        return [cls.shard_key(generation, number)
+                for number in range(1, RANKING_SHARDS + 1)]
+
+    @classmethod
+    def bucket_counts(cls):
+        """Returns a list of the number of Users in each rank bucket."""
+        generation = RankingState.current_async().get_result().generation
+        totals = [0] * RANK_BUCKETS
+        for shard in ndb.get_multi(cls.all_keys(generation)):
+            if shard:
+                for bucket, count in enumerate(shard.counts[:RANK_BUCKETS]):
+                    totals[bucket] += count
+        return totals
+
+    def move_user(self, old_bucket, new_bucket):
+        """Count a User as having moved from one rank bucket to another.
+        old_bucket is None for new Users."""
+        if old_bucket is not None:
+            self.counts[old_bucket] -= 1
+        self.counts[new_bucket] += 1
+
+
+class RankingState(ndb.Model):
+    """Which generation of RankingShards holds the live counts, and the
+    progress of a rebuild of the counts into the next generation, if one is
+    running. There is only one, stored once the counts are first rebuilt."""
+    generation = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    rebuilding = ndb.BooleanProperty(required=True, default=False,
+                                     indexed=False)
+    # urlsafe cursor of the next batch of Users to count, None at the start
+    cursor = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def current_async(cls):
+        """Returns a Future for the RankingState."""
+        state = yield cls.get_by_id_async(1)
+        raise ndb.Return(state or cls(id=1))
+
+    @property
+    def next_generation(self):
+        """The generation of RankingShards written by a rebuild."""
+        return self.generation + 1
+
+
+class RankingsEmail(ndb.Model):
+    """A run of the rankings email cron job. Holds the rankings table sent to
+    every user, and a checkpoint of how far through the recipients the run
+    has got."""
+    table = ndb.TextProperty(required=True)
+    # urlsafe cursor of the next batch of recipients, None at the start
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False)
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True)
+    updated = ndb.DateTimeProperty(required=True, auto_now=True)
+
+    @classmethod
+    def render_table(cls, limit):
+        """Return the rankings table of the top limit users, as text."""
+        rankings_format = "{:<6}{:<15}{:<15}\n"
+        header = rankings_format.format("Rank", "Name", "Win/loss ratio")
+        lines = [rankings_format.format(form.rank, form.name,
+                                        form.win_loss_ratio)
+                 for form in User.rankings(limit).rankings]
+        return header + ''.join(lines)
+
+
+class RankingsEmailBatch(ndb.Model):
+    """A batch of recipients of a RankingsEmail, the parent entity, with a
+    checkpoint of how many of them have been sent the email."""
+    users = ndb.KeyProperty(kind=User, repeated=True, indexed=False)
+    sent = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False)
+    updated = ndb.DateTimeProperty(required=True, auto_now=True)
+
+
+class GameExport(ndb.Model):
+    """An export of every finished Game to a kalah_export archive, with a
+    checkpoint of how far through the Games it has got."""
+    # urlsafe cursor of the next page of Games, None at the start
+    cursor = ndb.StringProperty(indexed=False)
+    chunks = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # Size in bytes of each chunk, in order, so that the archive's index can
+    # be written without reading the chunks
+    chunk_sizes = ndb.IntegerProperty(repeated=True, indexed=False)
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False)
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True)
+
+
+class GameExportChunk(ndb.Model):
+    """One chunk of a GameExport, the parent entity, encoded by
+    kalah_export.encode_chunk. Numbered from 1 in order."""
+    data = ndb.BlobProperty(required=True)
+
+
+def count_reminders_async(counter, delta=1):
+    """Add delta to one of the REMINDER_COUNTERS in memcache, returning a
+    Future."""
+    return ndb.get_context().memcache_incr('reminders:' + counter, delta,
+                                           initial_value=0)
+
+
+def get_reminder_counts():
+    """Returns a dict giving the value of each of the REMINDER_COUNTERS."""
+    futures = [ndb.get_context().memcache_get('reminders:' + counter)
+               for counter in REMINDER_COUNTERS]
+    return dict((counter, future.get_result() or 0)
+                for counter, future in zip(REMINDER_COUNTERS, futures))
+
+
+def _user_key_memcache_key(name):
+    """Return the memcache key under which a user name's User key is
+    cached."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return 'user_key:' + name
+
+
+def _game_form_memcache_key(urlsafe):
+    """Return the memcache key under which a Game's GameForm is cached."""
+    return 'game_form:' + urlsafe
+
+
+def _game_version_memcache_key(urlsafe):
+    """Return the memcache key under which a Game's version is cached."""
+    return 'game_version:' + urlsafe
+
+
+def _cached_form_version(cached):
+    """Return the Game version of a (version, encoded GameForm) pair cached
+    by Game.cache_form, or -1 for anything else left under its key."""
+    return cached[0] if isinstance(cached, tuple) else -1
+
+
+@ndb.tasklet
+def _memcache_set_newer_async(key, value, version, cached_version):
+    """Store value in memcache under key unless the value there is for the
+    same or a newer version, using compare-and-set so that a slow write for
+    an old version cannot replace one for a newer version.
+
+    Args:
+        key: The memcache key.
+        value: The value to store.
+        version: The version of the Game which value is for.
+        cached_version: A function returning the version of a cached value.
+    """
+    context = ndb.get_context()
+    for _ in range(GAME_FORM_CACHE_RETRIES):
+        cached = yield context.memcache_gets(key)
+        if cached is None:
+            if (yield context.memcache_add(key, value)):
+                return
+        elif cached_version(cached) >= version:
+            return
+        elif (yield context.memcache_cas(key, value)):
+            return
+
+
+class UserName(ndb.Model):
+    """Index of Users by name, keyed by the name, so that a User can be
+    found by name with a get rather than a query."""
+    user = ndb.KeyProperty(kind=User, required=True)
 
 
 class Game(ndb.Model):
     """Game object"""
     north_user = ndb.KeyProperty(required=True, kind='User')
     south_user = ndb.KeyProperty(required=True, kind='User')
-    game_state = ndb.PickleProperty(required=True)
+    # Copies of the users' names, so that forms can be built without fetching
+    # the users. Games created before these were added do not have them.
+    north_user_name = ndb.StringProperty()
+    south_user_name = ndb.StringProperty()
+    game_state = GameStateProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     canceled = ndb.BooleanProperty(required=True, default=False)
     # Included to overcome query restrictions outlawing inequality
     # filters on more than one property:
     active = ndb.ComputedProperty(
         lambda self: (not self.game_over) and (not self.canceled))
+    # Both players, so that a user's games can be found with one equality
+    # filter rather than an OR query, which cannot be paged through
+    players = ndb.ComputedProperty(
+        lambda self: [self.north_user, self.south_user], repeated=True)
     north_final_score = ndb.IntegerProperty(required=False)
     south_final_score = ndb.IntegerProperty(required=False)
     history = ndb.IntegerProperty(repeated=True)  # move history
+    # Game states every kalah_replay.SNAPSHOT_INTERVAL moves, for state_at
+    snapshots = GameStateProperty(repeated=True)
+    # Kalah(houses, seeds) variant being played
+    houses = ndb.IntegerProperty(required=True,
+                                 default=kalah.DEFAULT_VARIANT[0])
+    seeds = ndb.IntegerProperty(required=True,
+                                default=kalah.DEFAULT_VARIANT[1])
+    # Increased on every change to the game, to identify cached GameForms
+    version = ndb.IntegerProperty(required=True, default=0)
+    # The kalah.RULES_VERSION the game is played under. Games created before
+    # this was stored have 0, since they may have been played under older
+    # rules, and are never replayed.
+    rules_version = ndb.IntegerProperty(required=True, default=0,
+                                        indexed=False)
+
+    @property
+    def replayable(self):
+        """Whether the Game's history can be replayed with kalah.move."""
+        return self.rules_version == kalah.RULES_VERSION
+
+    @property
+    def variant(self):
+        """The kalah.Variant being played."""
+        return kalah.get_variant(self.houses, self.seeds)
 
     @classmethod
-    def new_game(cls, north_user, south_user):
-        """Creates and returns a new game."""
+    def new_game(cls, north_user, south_user,
+                 houses=kalah.DEFAULT_VARIANT[0],
+                 seeds=kalah.DEFAULT_VARIANT[1]):
+        """Creates and returns a new game of Kalah(houses, seeds) between two
+        Users. ValueError will be raised if the variant is not supported."""
         new_game_state = kalah.newGame(
-            north_starts=random.choice([True, False]))
-        game = cls(north_user=north_user,
-                   south_user=south_user,
+            north_starts=random.choice([True, False]),
+            houses=houses, seeds=seeds)
+        game = cls(north_user=north_user.key,
+                   south_user=south_user.key,
+                   north_user_name=north_user.name,
+                   south_user_name=south_user.name,
                    game_state=new_game_state,
-                   game_over=False)
+                   game_over=False,
+                   houses=houses,
+                   seeds=seeds,
+                   rules_version=kalah.RULES_VERSION)
         game.put()
+        game.cache_form()
         return game
 
-    @ndb.transactional(xg=True)
     def move(self, house):
-        """Accepts move, updates game state, returns a GameForm."""
+        """Accepts move, updates game state, returns the updated Game. The
+        move is made on the Game as stored, which must not have changed
+        since this Game was read; this Game is left as it is.
+
+        Raises:
+            ValueError: If the move is invalid.
+            GameChangedError: If the stored Game has changed.
+        """
+        return self.move_async(house).get_result()
+
+    @ndb.tasklet
+    def move_async(self, house):
+        """Asynchronous version of move, returning a Future for the Game."""
+        game, results = yield self._move_async(house)
+        cache_future = game.cache_form_async()
+        if results:
+            try:
+                yield User.schedule_fold_async(
+                    [game.north_user, game.south_user], results)
+            except taskqueue.Error as e:
+                # The move is saved, and the results will be folded by the
+                # next sweep for waiting results
+                logging.warning('Could not queue folds for %s: %r',
+                                game.key, e)
+        yield cache_future
+        raise ndb.Return(game)
+
+    @ndb.transactional_tasklet(xg=True)
+    def _move_async(self, house):
+        # The Game is read again, so that the move is only made if nothing
+        # has changed it since the move was checked, and so that a retried
+        # transaction starts again from the stored Game
+        game = yield self.key.get_async()
+        if game.version != self.version or not game.active:
+            raise GameChangedError(game)
+
         # Calculate result of move.
         # ValueError will be raised by kalah.move if move is invalid
-        old_game_state = self.game_state
-        new_game_state = kalah.move(old_game_state, house)
+        with timed('rules'):
+            old_game_state = game.game_state
+            new_game_state = kalah.move(old_game_state, house, game.variant)
 
-        # record move history
-        self.history.append(house)
+            # record move history
+            game.history.append(house)
+            # Games played under older rules cannot be replayed, so are
+            # never given snapshots
+            if game.replayable and \
+                    len(game.history) % kalah_replay.SNAPSHOT_INTERVAL == 0:
+                if len(game.snapshots) == (len(game.history) //
+                                           kalah_replay.SNAPSHOT_INTERVAL - 1):
+                    game.snapshots.append(new_game_state)
+                else:
+                    # Snapshots are missing, so rebuild them, but never fail
+                    # the move if the history does not replay
+                    try:
+                        game.snapshots = kalah_replay.snapshots(
+                            game.history, game.variant)
+                    except ValueError:
+                        game.snapshots = []
 
-        # Check if the game is over
-        final_scores = kalah.winner(new_game_state)
+            # Check if the game is over
+            final_scores = kalah.winner(new_game_state, game.variant)
+        # The players' results are logged as GameResults rather than added to
+        # the Users, so that players finishing many games at once do not
+        # contend for their User entity group
+        results = []
         if final_scores:
-            self.game_over = True
-            self.south_final_score = final_scores[0]
-            self.north_final_score = final_scores[1]
+            game.game_over = True
+            game.south_final_score = final_scores[0]
+            game.north_final_score = final_scores[1]
 
             # Update user ranking info
             # win is 1, lose is -1, draw is 0
@@ -117,28 +864,241 @@ class Game(ndb.Model):
             else:
                 north_result = -1
                 south_result = 1
-            self.north_user.get().record_result(north_result)
-            self.south_user.get().record_result(south_result)
+            results = [GameResult(user=game.north_user,
+                                  result=north_result),
+                       GameResult(user=game.south_user,
+                                  result=south_result)]
 
         # Update game state
-        self.game_state = new_game_state
+        game.game_state = new_game_state
+        game.version += 1
 
         # Save changes to database
-        self.put()
+        yield ndb.put_multi_async([game] + results)
+
+        raise ndb.Return((game, results))
 
-        return self
+    @classmethod
+    def get_completed(cls, page_size=DEFAULT_PAGE_SIZE, cursor=None,
+                      summary_only=False):
+        """Gets a page of completed games. See User.get_games for the
+        arguments.
+
+        Returns:
+            A tuple of the form (games, next cursor, more).
+        """
+        qry = cls.query(cls.game_over == True)
+        # game_over is filtered on, so it cannot be projected
+        projection = ((cls.north_user_name, cls.south_user_name,
+                       cls.canceled)
+                      if summary_only else None)
+        return qry.fetch_page(page_size, start_cursor=cursor,
+                              projection=projection)
+
+    @classmethod
+    def fill_user_names(cls, games):
+        """Fill in the user names of any of the given Games which were
+        created before user names were stored on Games, fetching all of the
+        users needed in a single batch."""
+        missing = [game for game in games
+                   if game.north_user_name is None or
+                   game.south_user_name is None]
+        if not missing:
+            return
+        keys = list(set(key for game in missing
+                        for key in (game.north_user, game.south_user)))
+        names = dict((key, user.name)
+                     for key, user in zip(keys, ndb.get_multi(keys)))
+        for game in missing:
+            game.north_user_name = names[game.north_user]
+            game.south_user_name = names[game.south_user]
+
+    @classmethod
+    def update_user_name(cls, user_key, name, page_size=DEFAULT_PAGE_SIZE,
+                         cursor=None):
+        """Update the copies of a user's name stored on one page of their
+        Games, each in its own transaction so that moves made meanwhile are
+        kept.
+
+        Args:
+            user_key: The key of the User.
+            name: The User's name.
+            page_size: The number of Games to update.
+            cursor: A Cursor marking where the page starts, or None for the
+                first page.
+
+        Returns:
+            A tuple of the form (Games changed, next cursor, more).
+        """
+        keys, next_cursor, more = cls.query(
+            cls.players == user_key).fetch_page(
+                page_size, start_cursor=cursor, keys_only=True)
+        futures = [cls._update_user_name_async(key, user_key, name)
+                   for key in keys]
+        games = [game for game in [future.get_result() for future in futures]
+                 if game]
+        for game in games:
+            game.cache_form()
+        return len(games), next_cursor, more
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _update_user_name_async(key, user_key, name):
+        """Update the copies of a user's name stored on a Game, returning a
+        Future for the Game, or for None if it did not need changing."""
+        game = yield key.get_async()
+        if game is None:
+            raise ndb.Return(None)
+        changed = False
+        if game.north_user == user_key and game.north_user_name != name:
+            game.north_user_name = name
+            changed = True
+        if game.south_user == user_key and game.south_user_name != name:
+            game.south_user_name = name
+            changed = True
+        if not changed:
+            raise ndb.Return(None)
+        game.version += 1
+        yield game.put_async()
+        raise ndb.Return(game)
 
     def cancel(self):
-        """Cancels the game if it is not already finished or canceled.
+        """Cancels the game if it is not already finished or canceled, and
+        returns the canceled Game.
         If the game is already finished or canceled, raises an
         AttributeError"""
-        if self.game_over:
+        game = self._cancel()
+        game.cache_form()
+        return game
+
+    @ndb.transactional
+    def _cancel(self):
+        # Read again, so that a move made since this Game was read is kept
+        game = self.key.get()
+        if game.game_over:
             raise AttributeError("Cannot cancel game once it has already finished.")
-        if self.canceled:
+        if game.canceled:
             raise AttributeError("Game already canceled.")
-        else:
-            self.canceled = True
-            self.put()
+        game.canceled = True
+        game.version += 1
+        game.put()
+        return game
+
+    def schedule_reminder_async(self):
+        """Queue a reminder to the player whose turn it is, returning a
+        Future. See schedule_reminders_async."""
+        return Game.schedule_reminders_async([self])
+
+    @staticmethod
+    @ndb.tasklet
+    def schedule_reminders_async(games):
+        """Queue reminders to the players whose turn it is in the given
+        Games, to be sent REMINDER_DELAY seconds from now in one email per
+        player with their other reminders from that time. All of the tasks
+        are queued in two batches, whatever the number of Games."""
+        if not games:
+            return
+        reminders = []
+        digests = {}
+        # Named by user and time, so that one task sends all of a user's
+        # reminders queued within REMINDER_DELAY seconds
+        period = int(time.time() // REMINDER_DELAY)
+        for game in games:
+            user_key = (game.north_user if game.game_state[0] == 'N'
+                        else game.south_user)
+            reminders.append(taskqueue.Task(
+                method='PULL', tag=user_key.urlsafe(),
+                payload='{}:{}'.format(game.key.urlsafe(),
+                                       len(game.history))))
+            name = 'remind-{}-{}'.format(user_key.urlsafe(), period)
+            if name not in digests:
+                digests[name] = taskqueue.Task(
+                    url='/tasks/send_reminder', name=name,
+                    params={'user_key': user_key.urlsafe()},
+                    countdown=REMINDER_DELAY)
+        yield [taskqueue.Queue(REMINDER_QUEUE).add_async(reminders),
+               count_reminders_async('enqueued', len(reminders))]
+        try:
+            yield taskqueue.Queue().add_async(digests.values())
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+        # Reminders which did not need a new task to send them
+        enqueued = sum(1 for digest in digests.values()
+                       if digest.was_enqueued)
+        if len(reminders) > enqueued:
+            yield count_reminders_async('coalesced', len(reminders) - enqueued)
+
+    def status_message(self):
+        """Returns the message given with the game state by get_game."""
+        return 'Time to make a move!' if self.active else ''
+
+    def cache_form(self):
+        """Store a GameForm for the current version of the Game in memcache,
+        for get_game. See cache_form_async."""
+        self.cache_form_async().get_result()
+
+    @ndb.tasklet
+    def cache_form_async(self):
+        """Asynchronous version of cache_form, returning a Future. Nothing
+        is stored if the form cached already is for the same or a newer
+        version, so that a stale read or a slow write cannot replace it."""
+        form = self.to_form(self.status_message())
+        urlsafe = self.key.urlsafe()
+        # The version is also stored on its own, for wait_for_move to poll
+        yield [_memcache_set_newer_async(
+                   _game_form_memcache_key(urlsafe),
+                   (self.version, protobuf.encode_message(form)),
+                   self.version, _cached_form_version),
+               _memcache_set_newer_async(
+                   _game_version_memcache_key(urlsafe), self.version,
+                   self.version, lambda version: version)]
+
+    @staticmethod
+    def get_cached_form(urlsafe):
+        """Returns the GameForm cached for the current version of a Game,
+        or None if none is cached.
+
+        Args:
+            urlsafe: The urlsafe key string of the Game.
+        """
+        try:
+            key = ndb.Key(urlsafe=urlsafe)
+        except Exception:
+            # Left to get_by_urlsafe to report
+            return None
+        if key.kind() != Game._get_kind():
+            return None
+        cached = ndb.get_context().memcache_get(
+            _game_form_memcache_key(key.urlsafe())).get_result()
+        # Forms cached before versions were stored with them are ignored
+        if not isinstance(cached, tuple):
+            GAME_FORM_CACHE_STATS['misses'] += 1
+            return None
+        GAME_FORM_CACHE_STATS['hits'] += 1
+        return protobuf.decode_message(GameForm, cached[1])
+
+    @staticmethod
+    def get_cached_version(urlsafe):
+        """Returns the version of a Game stored in memcache by cache_form,
+        or None if it is not cached. This is much smaller than the GameForm,
+        so it is cheap to poll.
+
+        Args:
+            urlsafe: The urlsafe key string of the Game, as given by
+                GameForm.urlsafe_key.
+        """
+        return ndb.get_context().memcache_get(
+            _game_version_memcache_key(urlsafe)).get_result()
+
+    @staticmethod
+    def form_cache_hit_rate():
+        """Returns the fraction of get_cached_form calls in this instance
+        which found a cached form, or None if there have been none."""
+        lookups = sum(GAME_FORM_CACHE_STATS.values())
+        if not lookups:
+            return None
+        return float(GAME_FORM_CACHE_STATS['hits']) / lookups
 
     def to_form(self, message=''):
         """Returns a GameForm representation of the Game"""
@@ -146,20 +1106,87 @@ class Game(ndb.Model):
 
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.north_user_name = self.north_user.get().name
-        form.south_user_name = self.south_user.get().name
+        Game.fill_user_names([self])
+        form.north_user_name = self.north_user_name
+        form.south_user_name = self.south_user_name
         form.game_over = self.game_over
         form.canceled = self.canceled
         form.message = message
         form.next_to_play = self.game_state[0]
         form.board = board
         form.pretty_board = kalah.print_board_plus_legend(board).splitlines()
+        form.houses = self.houses
+        form.seeds = self.seeds
+        form.version = self.version
+        form.move_count = len(self.history)
         if self.south_final_score:
             form.south_final_score = self.south_final_score
         if self.north_final_score:
             form.north_final_score = self.north_final_score
         return form
 
+    def to_summary_form(self, game_over=None):
+        """Returns a GameSummaryForm representation of the Game. Only the
+        user names, game_over and canceled are needed, so this works on
+        Games loaded by projection queries.
+
+        Args:
+            game_over: Whether the game is over, if that is already known
+                rather than loaded.
+        """
+        form = GameSummaryForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.north_user_name = self.north_user_name
+        form.south_user_name = self.south_user_name
+        form.game_over = self.game_over if game_over is None else game_over
+        form.canceled = self.canceled
+        return form
+
+    def state_at(self, ply):
+        """Returns the game state after the first ply moves of the Game.
+        ValueError will be raised if ply is out of range, or if the Game
+        cannot be replayed to find it."""
+        if not 0 <= ply <= len(self.history):
+            raise ValueError("Ply must be between 0 and {}.".format(
+                len(self.history)))
+        if ply == len(self.history):
+            return self.game_state
+        if not self.replayable:
+            raise ValueError("Earlier boards are not available for games "
+                             "started under older rules.")
+        try:
+            with timed('rules'):
+                return kalah_replay.state_at(self.history, ply, self.variant,
+                                             self.snapshots)
+        except ValueError:
+            raise ValueError("The game's history cannot be replayed.")
+
+    def to_board_form(self, ply):
+        """Returns a BoardForm giving the board after the first ply moves
+        of the Game. ValueError will be raised if ply is out of range."""
+        player, board = self.state_at(ply)
+        form = BoardForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.ply = ply
+        form.next_to_play = player
+        form.board = board
+        form.pretty_board = kalah.print_board_plus_legend(board).splitlines()
+        if ply < len(self.history):
+            form.house = self.history[ply]
+        return form
+
+    def to_export_record(self):
+        """Returns the finished Game as a dict, in the form archived by
+        kalah_export."""
+        return {'houses': self.houses, 'seeds': self.seeds,
+                'first': kalah_replay.initial_state(self.history,
+                                                    self.variant)[0],
+                'moves': self.history,
+                'scores': [self.south_final_score or 0,
+                           self.north_final_score or 0],
+                'north': self.north_user_name,
+                'south': self.south_user_name}
+
     def to_history_form(self, verbose=False):
         """Returns a GameHistoryForm detailing the move history of the Game,
         as a list of houses chosen on each turn."""
@@ -169,22 +1196,31 @@ class Game(ndb.Model):
 
         # Add details for verbose history:
         if verbose:
-            # Populate verbose history
-            for house in self.history:
-                # Determine whether North or South player played
-                player = 'S' if house < 6 else 'N'
-
+            # Populate verbose history, replaying the game to find who
+            # played each move, or from the side of the board of each house
+            # if the game cannot be replayed
+            players = None
+            if self.replayable:
+                try:
+                    with timed('rules'):
+                        players = kalah_replay.players(self.history,
+                                                       self.variant)
+                except ValueError:
+                    pass
+            if players is None:
+                players = kalah_replay.players_by_side(self.history,
+                                                       self.variant)
+            for player, house in zip(players, self.history):
                 # Construct verbose record of move
                 move_form = MoveForm()
                 move_form.player = player
                 move_form.house = house
                 history_form.verbose_history.append(move_form)
-                # Alternate players
-                player = 'N' if player == 'S' else 'S'
 
             # Add player details
-            history_form.north_user_name = self.north_user.get().name
-            history_form.south_user_name = self.south_user.get().name
+            Game.fill_user_names([self])
+            history_form.north_user_name = self.north_user_name
+            history_form.south_user_name = self.south_user_name
 
         return history_form
 
@@ -213,12 +1249,25 @@ class GameForm(messages.Message):
                                               variant=messages.Variant.INT32)
     south_final_score = messages.IntegerField(11, required=False,
                                               variant=messages.Variant.INT32)
+    # The Kalah(houses, seeds) variant being played
+    houses = messages.IntegerField(12, variant=messages.Variant.INT32)
+    seeds = messages.IntegerField(13, variant=messages.Variant.INT32)
+    # Changes whenever the game does. See get_game.
+    version = messages.IntegerField(14, variant=messages.Variant.INT32)
+    # True if the game has not changed since the version asked for, in which
+    # case board and pretty_board are left out
+    not_modified = messages.BooleanField(15, default=False)
+    # The number of moves made so far. See wait_for_move.
+    move_count = messages.IntegerField(16, variant=messages.Variant.INT32)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     north_user_name = messages.StringField(1, required=True)
     south_user_name = messages.StringField(2, required=True)
+    # Optional, to play a Kalah(houses, seeds) variant other than Kalah(6, 3)
+    houses = messages.IntegerField(3, default=kalah.DEFAULT_VARIANT[0])
+    seeds = messages.IntegerField(4, default=kalah.DEFAULT_VARIANT[1])
 
 
 class MakeMoveForm(messages.Message):
@@ -227,20 +1276,66 @@ class MakeMoveForm(messages.Message):
     user_name = messages.StringField(2, required=True)
 
 
+class GameMoveForm(messages.Message):
+    """Used to make a move in one of several games at once"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    house = messages.IntegerField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make moves in several existing games at once"""
+    user_name = messages.StringField(1, required=True)
+    moves = messages.MessageField(GameMoveForm, 2, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """The result of one of several moves: either the game state with a
+    message, as from make_move, or an error if the game could not be
+    found"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    game = messages.MessageField(GameForm, 2)
+    error = messages.StringField(3)
+
+
+class MoveResultsForm(messages.Message):
+    """Form for outbound results of several moves, in the order they were
+    given"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
+class GameSummaryForm(messages.Message):
+    """GameSummaryForm for outbound summaries of games, without the game
+    state"""
+    urlsafe_key = messages.StringField(1, required=True)
+    north_user_name = messages.StringField(2, required=True)
+    south_user_name = messages.StringField(3, required=True)
+    game_over = messages.BooleanField(4, required=True)
+    canceled = messages.BooleanField(5, required=True)
+
+
 class GamesForm(messages.Message):
     """Form for outbound list of games"""
     games = messages.MessageField(GameForm, 1, repeated=True)
+    # Used instead of games when only summaries are requested
+    summaries = messages.MessageField(GameSummaryForm, 2, repeated=True)
+    # Cursor to pass to fetch the next page, and whether there may be more
+    next_cursor = messages.StringField(3)
+    more = messages.BooleanField(4)
 
 
 class UserRankingInfoForm(messages.Message):
     """Form for outbound ranking info about an individual User"""
     name = messages.StringField(1, required=True)
     win_loss_ratio = messages.FloatField(2, required=True)
+    # Users with equal win to loss ratios and draws share a rank
+    rank = messages.IntegerField(3)
 
 
 class UserRankingsForm(messages.Message):
     """Form for outbound User ranking list"""
     rankings = messages.MessageField(UserRankingInfoForm, 1, repeated=True)
+    # Pass as cursor to fetch the next page. Left out on the last page.
+    next_cursor = messages.StringField(2)
 
 
 class MoveForm(messages.Message):
@@ -260,6 +1355,30 @@ class GameHistoryForm(messages.Message):
     south_user_name = messages.StringField(6, required=False)
 
 
+class BoardForm(messages.Message):
+    """Form for outbound boards from a point in a Game's history"""
+    urlsafe_key = messages.StringField(1, required=True)
+    # The number of moves made before this point
+    ply = messages.IntegerField(2, required=True,
+                                variant=messages.Variant.INT32)
+    # Either 'N' or 'S':
+    next_to_play = messages.StringField(3, required=True)
+    board = messages.IntegerField(4, repeated=True,
+                                  variant=messages.Variant.INT32)
+    pretty_board = messages.StringField(5, repeated=True)
+    # The house played next, unless this is the current board
+    house = messages.IntegerField(6, variant=messages.Variant.INT32)
+
+
+class MoveSuggestionForm(messages.Message):
+    """Form for outbound move suggestions"""
+    urlsafe_key = messages.StringField(1, required=True)
+    # Either 'N' or 'S':
+    next_to_play = messages.StringField(2, required=True)
+    house = messages.IntegerField(3, required=True,
+                                  variant=messages.Variant.INT32)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
@@ -1,11 +1,230 @@
 # """utils.py - File for collecting general utility functions."""
 
+import contextlib
+import functools
+import json
 import logging
+import math
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+# Statistics of the request being handled on this thread, while a method
+# decorated with instrumented is running: a Counter of API calls by
+# 'service.call', and of the measures in _STAT_NAMES.
+_request_stats = threading.local()
+
+# Most recent requests of each endpoint kept for percentiles, per instance
+STATS_WINDOW = 1000
+STATS_PERCENTILES = (50, 90, 99)
+# Measures recorded for every request, other than wall_ms
+_STAT_NAMES = ('rpcs', 'datastore_gets', 'datastore_get_entities',
+               'datastore_puts', 'datastore_put_entities', 'datastore_queries',
+               'datastore_commits', 'memcache_hits', 'memcache_misses',
+               'taskqueue_adds', 'rules_ms', 'ai_ms')
+
+
+def _current_stats():
+    """Return the statistics of the current request, or None if it is not
+    being instrumented."""
+    return getattr(_request_stats, 'stats', None)
+
+
+def _count_rpc(service, call, request, response):
+    """API proxy hook, called before every API call."""
+    stats = _current_stats()
+    if stats is None:
+        return
+    stats['{}.{}'.format(service, call)] += 1
+    stats['rpcs'] += 1
+    if service == 'datastore_v3':
+        if call == 'Get':
+            stats['datastore_gets'] += 1
+            stats['datastore_get_entities'] += request.key_size()
+        elif call == 'Put':
+            stats['datastore_puts'] += 1
+            stats['datastore_put_entities'] += request.entity_size()
+        elif call in ('RunQuery', 'Next'):
+            stats['datastore_queries'] += 1
+        elif call == 'Commit':
+            stats['datastore_commits'] += 1
+    elif (service, call) == ('taskqueue', 'BulkAdd'):
+        stats['taskqueue_adds'] += request.add_request_size()
+
+
+def _count_memcache_hits(service, call, request, response):
+    """API proxy hook, called after every API call."""
+    stats = _current_stats()
+    if stats is not None and (service, call) == ('memcache', 'Get'):
+        hits = response.item_size()
+        stats['memcache_hits'] += hits
+        stats['memcache_misses'] += request.key_size() - hits
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter',
+                                                    _count_rpc)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('memcache_hit_counter',
+                                                     _count_memcache_hits)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Context manager adding the milliseconds spent in it to the measure
+    '<name>_ms' of the current request, such as 'rules' for the game rules
+    in kalah and kalah_replay."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats = _current_stats()
+        if stats is not None:
+            stats[name + '_ms'] += (time.time() - start) * 1000
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+class RollingStats(object):
+    """Keeps the measures of the last window requests of each endpoint, in
+    this instance, and gives their percentiles.
+
+    Args:
+        window: The number of requests to keep for each endpoint.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = {}
+        # Requests are handled on several threads at once
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, sample):
+        """Record a dict of the measures of one request to an endpoint."""
+        with self._lock:
+            if endpoint not in self._samples:
+                self._samples[endpoint] = deque(maxlen=self.window)
+            self._samples[endpoint].append(sample)
+
+    def percentiles(self):
+        """Return a dict giving, for each endpoint, the number of requests
+        kept, the number of those which raised errors, and a dict of the
+        STATS_PERCENTILES of each measure, such as
+        {'wall_ms': {'p50': 12.5, 'p90': 40.1, 'p99': 85.0}, ...}."""
+        with self._lock:
+            samples = dict((endpoint, list(window))
+                           for endpoint, window in self._samples.items())
+        result = {}
+        for endpoint, window in samples.items():
+            measures = {}
+            for name in ('wall_ms',) + _STAT_NAMES:
+                values = sorted(sample[name] for sample in window)
+                measures[name] = dict(
+                    ('p{}'.format(percent), _percentile(values, percent))
+                    for percent in STATS_PERCENTILES)
+            result[endpoint] = {
+                'requests': len(window),
+                'errors': sum(1 for sample in window if sample['error']),
+                'measures': measures}
+        return result
+
+ENDPOINT_STATS = RollingStats(STATS_WINDOW)
+
+
+def instrumented(method):
+    """Decorator for API methods, which records the time taken to handle
+    each request, the API calls (such as datastore reads) made while
+    handling it and the time spent in the game rules. Logs them as one line
+    of JSON, starting 'endpoint_stats', and adds them to ENDPOINT_STATS."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        _request_stats.stats = stats = Counter()
+        start = time.time()
+        error = None
+        try:
+            return method(self, request)
+        except Exception, e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            _request_stats.stats = None
+            sample = dict((name, stats[name]) for name in _STAT_NAMES)
+            sample.update(wall_ms=(time.time() - start) * 1000, error=error)
+            for name in ('wall_ms', 'rules_ms', 'ai_ms'):
+                sample[name] = round(sample[name], 1)
+            ENDPOINT_STATS.add(method.__name__, sample)
+            calls = dict((name, count) for name, count in stats.items()
+                         if '.' in name)
+            logging.info('endpoint_stats %s', json.dumps(
+                dict(sample, endpoint=method.__name__, calls=calls),
+                sort_keys=True))
+    return wrapper
+
+
+class LRUCache(object):
+    """An in-process cache holding at most max_size items, which evicts
+    the least recently used item when it is full. Counts hits and misses.
+
+    Args:
+        max_size: The maximum number of items to hold.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        # Requests are handled on several threads at once
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Return the value cached for key, or None if there is none."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value for key, evicting the least recently used item if
+        the cache is full."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """Remove any value cached for key."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def hit_rate(self):
+        """Return the fraction of lookups which were hits, or None if there
+        have been none."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else None
+
 
 def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. See
+        get_by_urlsafe_async."""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
@@ -14,8 +233,8 @@ def get_by_urlsafe(urlsafe, model):
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        A Future for the entity that the urlsafe Key string points to or None
+        if no entity exists.
     Raises:
         ValueError:"""
     try:
@@ -28,9 +247,27 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+    entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)
+
+
+def get_cursor(urlsafe):
+    """Returns the query Cursor that a urlsafe cursor string represents, or
+        None if the string is empty. Raises an error if the string is
+        malformed.
+    Args:
+        urlsafe: A urlsafe cursor string, as returned by Cursor.urlsafe()
+    Returns:
+        A Cursor, or None.
+    Raises:
+        endpoints.BadRequestException:"""
+    if not urlsafe:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')